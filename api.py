@@ -0,0 +1,212 @@
+import hashlib
+import json
+
+from flask import (Blueprint, Response, abort, current_app, jsonify, request,
+                   stream_with_context)
+from werkzeug.exceptions import HTTPException
+
+import cache
+import models
+import pagination
+
+
+api = Blueprint("api", __name__, url_prefix="/api")
+
+COLUMNS = {
+    "id": models.Entry.id,
+    "slug": models.Entry.slug,
+    "title": models.Entry.title,
+    "date": models.Entry.date,
+    "time_spent": models.Entry.time_spent,
+    "content": models.Entry.content,
+    "html": models.Entry.content_html.alias("html"),
+    "excerpt": models.Entry.excerpt,
+    "author": models.User.username.alias("author"),
+}
+EMBEDS = ("tags", "resources")
+FIELDS = tuple(COLUMNS) + EMBEDS
+LIST_FIELDS = ("id", "slug", "title", "date", "time_spent", "author", "tags")
+
+
+def requested_fields(default):
+    """
+    Reads the fields= query argument, a comma separated list of FIELDS.
+    Aborts with 400 on unknown names.
+    """
+
+    text = request.args.get("fields")
+    if not text:
+        return default
+    fields = tuple(dict.fromkeys(
+        name.strip() for name in text.split(",") if name.strip()))
+    unknown = [name for name in fields if name not in FIELDS]
+    if unknown:
+        abort(400, "Unknown fields: {}.".format(", ".join(unknown)))
+    return fields
+
+
+def entry_query(fields):
+    """
+    Selects only the columns fields need, plus the (date, id) sort key,
+    as plain dictionaries
+    """
+
+    columns = [models.Entry.id, models.Entry.date]
+    columns += [COLUMNS[name] for name in fields
+                if name in COLUMNS and name not in ("id", "date")]
+    query = models.Entry.select(*columns)
+    if "author" in fields:
+        query = query.join(models.User, on=models.Entry.author)
+    return query.dicts()
+
+
+def serialize(rows, fields):
+    """
+    Shapes rows for output, embedding tags and resources loaded with one
+    batch query each
+    """
+
+    ids = [row["id"] for row in rows]
+    tags = models.tags_by_entry(ids) if "tags" in fields else {}
+    resources = {}
+    if "resources" in fields:
+        resources = models.resources_by_entry(ids)
+    for row in rows:
+        record = {}
+        for name in fields:
+            if name == "tags":
+                record[name] = tags[row["id"]]
+            elif name == "resources":
+                record[name] = [
+                    {"title": resource.title, "link": resource.link}
+                    for resource in resources[row["id"]]
+                ]
+            elif name == "date":
+                record[name] = str(row["date"])
+            else:
+                record[name] = row[name]
+        yield record
+
+
+def encode_tag_cursor(tag):
+    """Builds an opaque cursor from a Tag's (entry_count, id) sort key"""
+
+    return "{}_{}".format(tag.entry_count, tag.id)
+
+
+def decode_tag_cursor(cursor):
+    """
+    Parses a tag cursor back into its (entry_count, id) sort key. Raises
+    ValueError if the cursor is malformed.
+    """
+
+    count, _, tag_id = cursor.partition("_")
+    return int(count), int(tag_id)
+
+
+@api.route("/entries")
+@api.route("/entries/<tag>/topic")
+def entries(tag=None):
+    """
+    Lists entries newest first with keyset cursors. The JSON body is
+    streamed record by record rather than rendered as one string. The
+    ETag comes from the page's keys and the cache event position, which
+    moves with every committed write, so it is known before anything is
+    serialized.
+    """
+
+    fields = requested_fields(LIST_FIELDS)
+    query = entry_query(fields)
+    if tag:
+        query = query.switch(models.Entry).join(
+            models.EntryTag, on=(models.EntryTag.entry == models.Entry.id)
+        ).join(
+            models.Tag, on=(models.EntryTag.tag == models.Tag.id)
+        ).where(models.Tag.topic == tag)
+    after = request.args.get("after")
+    before = request.args.get("before")
+    try:
+        rows, more = pagination.seek(
+            query,
+            (models.Entry.date, models.Entry.id),
+            after=pagination.decode_cursor(after) if after else None,
+            before=pagination.decode_cursor(before) if before else None,
+            size=pagination.page_size(
+                request.args.get("size"), current_app.config["PAGE_SIZE"]),
+        )
+    except ValueError:
+        abort(400, "That's not a valid page.")
+    page = pagination.make_page(
+        rows, more, after, before,
+        lambda row: pagination.encode_key(row["date"], row["id"]),
+    )
+
+    def generate():
+        yield '{"entries": ['
+        for index, record in enumerate(serialize(page.entries, fields)):
+            yield ("," if index else "") + json.dumps(record)
+        yield '], "next": {}, "prev": {}}}'.format(
+            json.dumps(page.next_cursor), json.dumps(page.prev_cursor))
+
+    digest = hashlib.sha1(repr((
+        fields, [(str(row["date"]), row["id"]) for row in page.entries],
+        page.next_cursor, page.prev_cursor, cache.position,
+    )).encode("utf-8")).hexdigest()
+    return cache.conditional(
+        Response(stream_with_context(generate()),
+                 mimetype="application/json"),
+        digest,
+    )
+
+
+@api.route("/entries/<slug>")
+def entry(slug):
+    """A single entry, with every field unless fields= narrows it"""
+
+    fields = requested_fields(FIELDS)
+    rows = list(entry_query(fields).where(models.Entry.slug == slug))
+    if not rows:
+        abort(404, "That entry doesn't exist.")
+    response = jsonify(next(serialize(rows, fields)))
+    return cache.conditional(
+        response, hashlib.sha1(response.get_data()).hexdigest()
+    )
+
+
+@api.route("/tags")
+def tags():
+    """
+    Tags with their entry counts, most popular first, with keyset cursors
+    on (entry_count, id)
+    """
+
+    after = request.args.get("after")
+    before = request.args.get("before")
+    try:
+        rows, more = pagination.seek(
+            models.Tag.select().where(models.Tag.entry_count > 0),
+            (models.Tag.entry_count, models.Tag.id),
+            after=decode_tag_cursor(after) if after else None,
+            before=decode_tag_cursor(before) if before else None,
+            size=pagination.page_size(
+                request.args.get("size", pagination.MAX_PAGE_SIZE)),
+        )
+    except ValueError:
+        abort(400, "That's not a valid page.")
+    page = pagination.make_page(rows, more, after, before, encode_tag_cursor)
+    response = jsonify({
+        "tags": [{"topic": tag.topic, "entries": tag.entry_count}
+                 for tag in page.entries],
+        "next": page.next_cursor,
+        "prev": page.prev_cursor,
+    })
+    return cache.conditional(
+        response, hashlib.sha1(response.get_data()).hexdigest()
+    )
+
+
+@api.errorhandler(HTTPException)
+def api_error(error):
+    """Reports errors from the API as JSON rather than HTML pages"""
+
+    return jsonify({"error": error.description}), error.code
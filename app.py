@@ -1,231 +1,538 @@
+import datetime
+import os
 from functools import wraps
 from urllib.parse import urlparse
 
-from flask import (Flask, render_template, redirect, url_for, g, request,
-                   abort, flash)
-from flask_bcrypt import check_password_hash
+from flask import (Flask, Response, render_template, redirect, url_for, g,
+                   request, abort, flash, current_app)
 from flask_login import (login_required, LoginManager, login_user, logout_user,
                          current_user)
+from peewee import DoesNotExist
 from werkzeug.exceptions import HTTPException
 
+import api
+import cache
+import commands
 import handlers
+import jobs
+import metrics
 import models
+import pagination
+import passwords
+import ratelimit
+import search
+import users
 import forms
-import dummy_data
 
 
-DUMMYDATA = True
-DEBUG = True
-PORT = 8000
-HOST = "0.0.0.0"
-
-app = Flask(__name__)
-app.secret_key = "secretkey"
+TAG_CLOUD_SIZE = 200
+DASHBOARD_PERIODS = {"day": 31, "week": 26, "month": 24}
+NO_DATABASE_ENDPOINTS = {"static", "metrics_view"}
+ENV_PREFIX = "JOURNAL_"
+DEV_SECRET_KEY = "dev"
+PRAGMA_SETTINGS = {
+    "SQLITE_BUSY_TIMEOUT": "busy_timeout",
+    "SQLITE_SYNCHRONOUS": "synchronous",
+    "SQLITE_CACHE_SIZE": "cache_size",
+    "SQLITE_MMAP_SIZE": "mmap_size",
+}
+DEFAULTS = {
+    "SECRET_KEY": None,
+    "DEBUG": False,
+    "HOST": "0.0.0.0",
+    "PORT": 8000,
+    "DATABASE": models.DATABASE_NAME,
+    "MAX_CONNECTIONS": models.MAX_CONNECTIONS,
+    "JOB_WORKERS": jobs.WORKERS,
+    "BCRYPT_ROUNDS": passwords.BCRYPT_ROUNDS,
+    "BCRYPT_WORKERS": passwords.WORKERS,
+    "BCRYPT_MAX_QUEUE": passwords.MAX_QUEUE,
+    "BCRYPT_TIMEOUT": passwords.TIMEOUT,
+    "SLOW_REQUEST_SECONDS": metrics.SLOW_REQUEST_SECONDS,
+    "SIGNED_SESSION": users.SIGNED_SESSION,
+    "PAGE_SIZE": pagination.PAGE_SIZE,
+    **{name: models.PRAGMAS[pragma]
+       for name, pragma in PRAGMA_SETTINGS.items()},
+}
+ROUTES = []
 
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = "login"
 
 
+def route(rule, **options):
+    """
+    Records a view for create_app to register, like Flask.route. Views
+    keep their plain endpoint names, e.g. url_for("index").
+    """
+
+    def register(view):
+        ROUTES.append((rule, view, options))
+        return view
+    return register
+
+
+def config_from_env(environ=None):
+    """
+    Reads JOURNAL_<NAME> environment variables for every name in DEFAULTS,
+    converting each to the type of its default
+    """
+
+    environ = os.environ if environ is None else environ
+    config = {}
+    for name, default in DEFAULTS.items():
+        value = environ.get(ENV_PREFIX + name)
+        if value is None:
+            continue
+        if isinstance(default, bool):
+            value = value.lower() in ("1", "true", "yes", "on")
+        elif isinstance(default, int):
+            value = int(value)
+        elif isinstance(default, float):
+            value = float(value)
+        config[name] = value
+    return config
+
+
+def create_app(config=None):
+    """
+    Builds the journal app from DEFAULTS, then JOURNAL_* environment
+    variables, then config. The database is only pointed at its file
+    here; each worker opens its own pooled connections and starts its
+    JOB_WORKERS background job threads on its first request, so the app
+    is safe to create before a pre-fork server forks. With DATABASE set
+    to ":memory:" job workers are off; run jobs with jobs.drain(). A
+    SECRET_KEY is required unless DEBUG or TESTING is on.
+
+    Parameters:
+    config (dict): settings that override the environment
+
+    Returns:
+    Instance of Flask
+    """
+
+    app = Flask(__name__)
+    app.config.update(DEFAULTS)
+    app.config.update(config_from_env())
+    app.config.update(config or {})
+    if not app.config["SECRET_KEY"]:
+        if not (app.debug or app.testing):
+            raise RuntimeError(
+                "Set JOURNAL_SECRET_KEY: with a known key anyone can forge "
+                "session cookies.")
+        app.config["SECRET_KEY"] = DEV_SECRET_KEY
+
+    if app.config["DATABASE"] == models.MEMORY:
+        app.config["JOB_WORKERS"] = 0
+    models.init_database(
+        app.config["DATABASE"],
+        max_connections=app.config["MAX_CONNECTIONS"],
+        pragmas={pragma: app.config[name]
+                 for name, pragma in PRAGMA_SETTINGS.items()},
+    )
+    passwords.configure(
+        rounds=app.config["BCRYPT_ROUNDS"],
+        workers=app.config["BCRYPT_WORKERS"],
+        max_queue=app.config["BCRYPT_MAX_QUEUE"],
+        timeout=app.config["BCRYPT_TIMEOUT"],
+    )
+    handlers.register_tasks()
+    metrics.init_app(app)
+    login_manager.init_app(app)
+    app.before_first_request(
+        lambda: jobs.start_workers(app.config["JOB_WORKERS"]))
+    app.before_request(before_request)
+    app.teardown_request(teardown_request)
+    app.register_error_handler(HTTPException, http_error)
+    for rule, view, options in ROUTES:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.register_blueprint(api.api)
+    app.cli.add_command(commands.journal)
+    return app
+
+
 @login_manager.user_loader
 def load_user(userid):
     """Retrieves instance of User"""
 
     try:
-        return models.User.get(models.User.id == userid)
-    except models.DoesNotExist:
+        return users.load_user(userid)
+    except DoesNotExist:
         abort(404, message="That user doesn't exist.")
 
 
+def get_entry(slug):
+    """
+    Loads an entry with its author, resources and tags through a
+    request-scoped identity map, so every caller in the same request
+    shares one instance. Aborts with 404 if the entry doesn't exist.
+    """
+
+    entries = g.setdefault("entries", {})
+    if slug not in entries:
+        try:
+            entries[slug] = models.load_entry(slug)
+        except DoesNotExist:
+            abort(404, "That entry doesn't exist.")
+    return entries[slug]
+
+
 def check_ownership(func):
     """Verifies that current user is owner of requested post"""
 
     @wraps(func)
     def decorator(*args, **kwargs):
-        slug = kwargs["slug"]
-        try:
-            entry = models.Entry.get(
-                models.Entry.slug == slug,
-            )
-        except models.DoesNotExist:
-            abort(404, "That entry doesn't exist.")
-        if entry.author != current_user:
+        entry = get_entry(kwargs["slug"])
+        if str(entry.author_id) != current_user.get_id():
             abort(403, "You aren't the owner of this post.")
         return func(*args, **kwargs)
     return decorator
 
 
-@app.route("/login", methods=("GET", "POST",))
+def throttle(email=None):
+    """
+    Spends a login/signup attempt for the client's IP address and, when
+    given, the account's email. Aborts with 429 once either runs out.
+    """
+
+    allowed = ratelimit.IPS.allow(request.remote_addr)
+    if email:
+        allowed = ratelimit.ACCOUNTS.allow(email.lower()) and allowed
+    if not allowed:
+        abort(429, "Too many attempts, please wait a minute.")
+
+
+@route("/login", methods=("GET", "POST",))
 def login():
     """
     View that requests user's credentials and creates a new session for user
     """
 
     form = forms.LoginForm()
+    if request.method == "POST":
+        throttle(form.email.data)
     if form.validate_on_submit():
         try:
             user = models.User.get(models.User.email == form.email.data)
-        except models.DoesNotExist:
+            valid = passwords.check_password(
+                user.password, form.password.data)
+        except DoesNotExist:
+            valid = False
+        except passwords.Busy:
+            abort(503, "We're busy logging people in, please try again.")
+        if not valid:
             flash("Username and password is incorrect!")
             return redirect(url_for("login"))
-        else:
-            if check_password_hash(user.password, form.password.data):
-                login_user(user)
-                flash("You're now logged in!")
-                next = request.args.get('next')
-                safe = urlparse(next).netloc == ""
-            if next:
-                if not safe:
-                    return abort(400, "That's not a valid redirect.")
-            return redirect(next or url_for('index'))
+        if passwords.needs_rehash(user.password):
+            try:
+                user.password = passwords.hash_password(form.password.data)
+                user.save()
+            except passwords.Busy:
+                pass
+        login_user(user)
+        users.remember(user)
+        flash("You're now logged in!")
+        next = request.args.get('next')
+        if next and urlparse(next).netloc != "":
+            return abort(400, "That's not a valid redirect.")
+        return redirect(next or url_for('index'))
     return render_template("login.html", form=form)
 
 
-@app.route("/logout")
+@route("/logout")
 def logout():
     """Ends current user's session"""
 
     logout_user()
+    users.forget()
     flash("You've been logged out!")
     return redirect(url_for('index'))
 
 
-@app.route("/signup", methods=("GET", "POST",))
+@route("/signup", methods=("GET", "POST",))
 def signup():
     """Registers new user if they don't already exist"""
 
     form = forms.SignUpForm()
+    if request.method == "POST":
+        throttle(form.email.data)
     if form.validate_on_submit():
-        models.User.create_user(
-            username=form.username.data,
-            email=form.email.data,
-            password=form.password.data,
-        )
+        try:
+            models.User.create_user(
+                username=form.username.data,
+                email=form.email.data,
+                password=form.password.data,
+            )
+        except passwords.Busy:
+            abort(503, "We're busy signing people up, please try again.")
         flash("Yay! You registered!")
         return redirect(url_for("login"))
     return render_template("signup.html", form=form)
 
 
-@app.before_request
 def before_request():
     """
-    Connect to the database before each request. Share the current 
-    user in a global variable.
+    Check a connection out of the database pool before each request that
+    needs one and apply cache events other requests and processes have
+    committed since. Share the current user in a global variable.
     """
 
+    if request.endpoint in NO_DATABASE_ENDPOINTS:
+        return
     g.db = models.DATABASE
-    g.db.connect()
+    g.db.connect(reuse_if_open=True)
+    g.changes = g.db.connection().total_changes
+    models.sync_cache()
     g.user = current_user
 
 
-@app.after_request
-def after_request(response):
+def teardown_request(exception):
     """
-    Close the database connection after each request and return a response
+    Return the database connection to the pool after each request, even
+    when the view raised. A request that wrote first applies the cache
+    events of its now committed writes, so this process serves no stale
+    page from here on. Then wake the job workers for anything the
+    request queued.
     """
 
-    g.db.close()
-    return response
+    db = g.pop("db", None)
+    if db is not None and not db.is_closed():
+        if db.connection().total_changes != g.changes:
+            models.sync_cache()
+        db.close()
+    jobs.notify()
 
 
-@app.route("/")
-@app.route("/entries")
-@app.route("/entries/<tag>/topic")
+@route("/")
+@route("/entries")
+@route("/entries/<tag>/topic")
+@cache.cached_page(cache.LISTINGS)
 def index(tag=None):
-    """Main view of journal. All entries are displayed here"""
+    """Main view of journal. Entries are displayed here a page at a time"""
 
     if tag:
         try:
             tag_model = models.Tag.get(
                 models.Tag.topic == tag,
             )
-            context = {
-                "entries": (
-                    models.Entry.select().join(
-                        models.EntryTag, on=models.EntryTag.entry
-                    ).where(
-                        models.EntryTag.tag == tag_model,
-                    )),
-                "heading": "{} posts".format(tag),
-            }
-        except models.DoesNotExist:
+        except DoesNotExist:
             abort(404, "That tag doesn't exist.")
+        query = models.Entry.listing().join(
+            models.EntryTag, on=models.EntryTag.entry
+        ).where(
+            models.EntryTag.tag == tag_model,
+        )
+        heading = "{} posts".format(tag)
     else:
-        context = {
-            "entries": models.Entry.select().order_by(
-                models.Entry.date.desc()
-            ),
-            "heading": "all posts"
-        }
+        query = models.Entry.listing()
+        heading = "all posts"
+    return render_listing(query, heading, tag=tag)
+
+
+def render_listing(query, heading, **context):
+    """Renders a page of the Entry query, newest first, with cursor links"""
+
+    try:
+        page = pagination.paginate(
+            query,
+            after=request.args.get("after"),
+            before=request.args.get("before"),
+            size=pagination.page_size(
+                request.args.get("size"), current_app.config["PAGE_SIZE"]),
+        )
+    except ValueError:
+        abort(400, "That's not a valid page.")
+    models.prefetch_tags(page.entries)
+    context.update({
+        "entries": page,
+        "page": page,
+        "heading": heading,
+    })
     return render_template("index.html", **context)
 
 
-@app.route("/entries/new", methods=("GET", "POST",))
+@route("/users/<username>")
+@cache.cached_page(cache.LISTINGS)
+def timeline(username):
+    """Entries of one author, a page at a time"""
+
+    try:
+        author = models.User.get(models.User.username == username)
+    except DoesNotExist:
+        abort(404, "That user doesn't exist.")
+    query = models.Entry.listing().where(models.Entry.author == author)
+    return render_listing(query, "{}'s posts".format(username))
+
+
+def archive_months():
+    """Entries per month for the archive navigation, from cache.MONTHS"""
+
+    stamp = cache.position
+    months = cache.MONTHS.get(cache.LISTINGS)
+    if months is None:
+        months = models.month_counts()
+        cache.store(cache.MONTHS, cache.LISTINGS, months, stamp)
+    return months
+
+
+@route("/archive")
+def latest_archive():
+    """Redirects to the newest month with entries"""
+
+    months = archive_months()
+    if not months:
+        abort(404, "There are no entries yet.")
+    start = months[0][0]
+    return redirect(url_for("archive", year=start.year, month=start.month))
+
+
+@route("/archive/<int:year>/<int:month>")
+@cache.cached_page(cache.LISTINGS)
+def archive(year, month):
+    """Entries dated in one month, a page at a time"""
+
+    try:
+        start = datetime.date(year, month, 1)
+        end = datetime.date(year + month // 12, month % 12 + 1, 1)
+    except ValueError:
+        abort(404, "That month doesn't exist.")
+    query = models.Entry.listing().where(
+        models.Entry.date >= start, models.Entry.date < end)
+    return render_listing(
+        query, start.strftime("%B %Y"), months=archive_months())
+
+
+@route("/tags")
+@cache.cached_page(cache.LISTINGS)
+def tags():
+    """Every topic in the journal, most popular first"""
+
+    context = {
+        "tags": models.popular_tags(TAG_CLOUD_SIZE),
+        "heading": "topics",
+    }
+    return render_template("tags.html", **context)
+
+
+def render_dashboard(heading, user=None, topic=None):
+    """
+    Renders hours logged per period, read from the rollup tables. The
+    period= query argument picks days, weeks or months.
+    """
+
+    period = request.args.get("period", "week")
+    if period not in DASHBOARD_PERIODS:
+        abort(400)
+    rollups = models.time_rollups(
+        period, DASHBOARD_PERIODS[period], user=user, topic=topic)
+    if topic is not None and not rollups:
+        abort(404)
+    context = {
+        "rollups": rollups,
+        "period": period,
+        "periods": DASHBOARD_PERIODS,
+        "most": max([rollup.time_spent for rollup in rollups] or [1]),
+        "tag": topic,
+        "heading": heading,
+    }
+    return render_template("dashboard.html", **context)
+
+
+@route("/dashboard")
+@login_required
+@cache.cached_page(cache.LISTINGS)
+def dashboard():
+    """Hours the current user spent learning"""
+
+    return render_dashboard("your learning", user=g.user.id)
+
+
+@route("/dashboard/<tag>")
+@cache.cached_page(cache.LISTINGS)
+def tag_dashboard(tag):
+    """Hours everyone spent learning a topic"""
+
+    return render_dashboard(tag, topic=tag)
+
+
+@route("/search")
+def search_view():
+    """Full-text search over entry titles, content and resources"""
+
+    text = request.args.get("q", "")
+    try:
+        page = search.search_entries(
+            text,
+            after=request.args.get("after"),
+            before=request.args.get("before"),
+            size=pagination.page_size(
+                request.args.get("size"), current_app.config["PAGE_SIZE"]),
+        )
+    except ValueError:
+        abort(400, "That's not a valid page.")
+    models.prefetch_tags(page.entries)
+    context = {
+        "entries": page,
+        "page": page,
+        "query": text,
+        "heading": "search",
+    }
+    return render_template("search.html", **context)
+
+
+@route("/entries/new", methods=("GET", "POST",))
 @login_required
 def add():
     """View to create new journal entry"""
 
     form = forms.AddEntryForm()
     if form.validate_on_submit():
+        entry = models.Entry(
+            author=g.user.id,
+            title=form.title.data,
+            content=form.content.data,
+            date=form.date.data,
+            time_spent=form.time_spent.data,
+        )
+        entry.render_content()
         try:
-            models.Entry.get(
-                models.Entry.title == form.title.data,
-            )
-        except models.DoesNotExist:
-            models.Entry.create_entry(
-                author=g.user._get_current_object(),
-                title=form.title.data,
-                content=form.content.data,
-                date=form.date.data,
-                time_spent=form.time_spent.data,
-            )
-            entry = models.Entry.get(
-                models.Entry.title**form.title.data
-            )
-            if form.tags.data:
-                handlers.tag_handler(entry, form)
-            if form.resources.data:
-                handlers.resource_handler(entry, form)
-                flash("New entry created!")
-                return redirect(url_for("index"))
-        flash("That title is taken! Please change.")
-        return render_template("new.html", form=form)
+            with models.DATABASE.atomic():
+                entry.insert_unique()
+                if form.tags.data:
+                    handlers.tag_handler(entry, form)
+                if form.resources.data:
+                    handlers.resource_handler(entry, form)
+        except models.IntegrityError:
+            flash("That title is taken! Please change.")
+            return render_template("new.html", form=form)
+        flash("New entry created!")
+        return redirect(url_for("index"))
     return render_template("new.html", form=form)
 
 
-@app.route("/entries/<slug>", methods=("GET",))
+@route("/entries/<slug>", methods=("GET",))
+@cache.cached_page()
 def detail(slug):
     """View to display details of a single post"""
 
-    try:
-        entry = models.Entry.get(
-            models.Entry.slug == slug
-        )
-        resource = models.Entry.resources
-    except models.DoesNotExist:
-        abort(404, "That entry doesn't exist.")
-    context = {
-        "entry": entry,
-        "resources": resource,
-    }
-    return render_template("detail.html", **context)
+    entry = get_entry(slug)
+    related = models.related_entries(entry)
+    g.cache_tags = {cache.entry_tag(other.id) for other in related}
+    return render_template("detail.html", entry=entry, related=related)
 
 
-@app.route("/entries/<slug>/edit", methods=("GET", "POST"))
+@route("/entries/<slug>/edit", methods=("GET", "POST"))
 @login_required
 @check_ownership
 def edit(slug):
     """View to allow editing of a single post"""
 
-    try:
-        entry = models.Entry.get(
-            models.Entry.slug == slug,
-        )
-    except models.DoesNotExist:
-        abort(404, "That entry doesn't exist")
-    else:
-        form = forms.EditEntryForm(obj=entry)
-        if form.validate_on_submit():
+    entry = get_entry(slug)
+    form = forms.EditEntryForm(obj=entry)
+    if form.validate_on_submit():
+        entry.content = form.content.data
+        entry.render_content()
+        try:
             with models.DATABASE.transaction():
                 if form.resources.data:
                     handlers.resource_handler(entry, form)
@@ -235,31 +542,50 @@ def edit(slug):
                     handlers.tag_handler(entry, form)
                 else:
                     handlers.delete_tag_handler(entry)
+                if form.title.data != entry.title:
+                    entry.slug = models.unique_slug(
+                        form.title.data, exclude=entry.id)
                 entry.title = form.title.data
-                entry.slug = "-".join(form.title.data.lower().split())
                 entry.time_spent = form.time_spent.data
-                entry.content = form.content.data
                 entry.date = form.date.data
                 entry.save()
-                flash("Entry edited successfuly!")
-                return redirect(url_for("detail", slug=entry.slug))
-        return render_template("edit.html", form=form, entry=entry)
+        except models.IntegrityError:
+            entry.slug = slug
+            flash("That title is taken! Please change.")
+            return render_template("edit.html", form=form, entry=entry)
+        flash("Entry edited successfuly!")
+        return redirect(url_for("detail", slug=entry.slug))
+    return render_template("edit.html", form=form, entry=entry)
 
 
-@app.route("/entries/<slug>/delete")
+@route("/entries/<slug>/delete")
 @login_required
 @check_ownership
 def delete(slug):
     """Deletes instance of current entry"""
 
-    models.Entry.get(
-        models.Entry.slug == slug
-    ).delete_instance()
+    handlers.delete_entry_handler(get_entry(slug))
+    g.entries.pop(slug)
     flash("Entry deleted successfuly")
     return redirect(url_for('index'))
 
 
-@app.errorhandler(HTTPException)
+@route("/metrics")
+def metrics_view():
+    """Request, SQL, template and bcrypt timings in Prometheus text format"""
+
+    counters = (
+        ("journal_cache_hits_total", "Lookups answered from a cache.", "cache",
+         {"pages": cache.PAGES.hits, "users": cache.USERS.hits,
+          "user_sessions": users.session_hits}),
+        ("journal_cache_misses_total", "Lookups a cache could not answer.",
+         "cache", {"pages": cache.PAGES.misses, "users": cache.USERS.misses}),
+    )
+    return Response(
+        metrics.render(counters), mimetype="text/plain; version=0.0.4"
+    )
+
+
 def http_error(HTTPException):
     """Handles abort calls and renders appropriate error page"""
 
@@ -269,7 +595,5 @@ def http_error(HTTPException):
 
 
 if __name__ == "__main__":
-    models.initialize_database()
-    if DUMMYDATA:
-        dummy_data.dummy_data()
-        app.run(debug=DEBUG, host=HOST, port=PORT)
+    app = create_app()
+    app.run(host=app.config["HOST"], port=app.config["PORT"])
@@ -0,0 +1,189 @@
+"""
+Online snapshots of the journal database.
+
+Snapshots are taken through SQLite rather than by copying the file, so
+they are consistent even while the app writes. The backup API copies
+STEP_PAGES pages at a time; in WAL mode readers never block writers, and
+the steps keep the copy from holding the disk for one long burst. A
+write from another connection makes SQLite restart the copy, so after
+MAX_RESTARTS restarts the rest is copied in a single step. VACUUM INTO
+writes a compacted snapshot in one read transaction instead.
+
+Every snapshot is written under a temporary name, switched out of WAL
+mode, checked with PRAGMA integrity_check and only then renamed, so a
+failed or interrupted backup never looks like a good one.
+"""
+
+import datetime
+import gzip
+import os
+import re
+import shutil
+import sqlite3
+import time
+
+import models
+
+
+STEP_PAGES = 1024
+STEP_SLEEP = 0.01
+MAX_RESTARTS = 5
+KEEP = 7
+PARTIAL_SUFFIX = ".partial"
+TIMESTAMP_FORMAT = "%Y%m%d-%H%M%S"
+
+
+class BackupError(Exception):
+    """Raised when a snapshot fails its integrity check"""
+
+
+class RestartLimit(Exception):
+    """Stops an incremental copy that keeps being restarted by writes"""
+
+
+def snapshot_name(stem, now=None, compress=False):
+    """File name of a snapshot of stem taken at now"""
+
+    now = now or datetime.datetime.now()
+    return "{}-{}.db{}".format(
+        stem, now.strftime(TIMESTAMP_FORMAT), ".gz" if compress else "")
+
+
+def snapshot_pattern(stem):
+    """Matches the file names snapshot_name gives for stem"""
+
+    return re.compile(r"^{}-\d{{8}}-\d{{6}}\.db(\.gz)?$".format(
+        re.escape(stem)))
+
+
+def copy_pages(source, path, pages=STEP_PAGES, sleep=STEP_SLEEP):
+    """
+    Copies source to a new database at path with the online backup API,
+    pages at a time, sleeping between steps
+
+    Returns:
+    Number of times writes made the copy start over
+    """
+
+    progress = {"remaining": None, "restarts": 0}
+
+    def step(status, remaining, total):
+        if progress["remaining"] is not None and (
+                remaining > progress["remaining"]):
+            progress["restarts"] += 1
+            if progress["restarts"] > MAX_RESTARTS:
+                raise RestartLimit()
+        progress["remaining"] = remaining
+        if remaining and sleep:
+            time.sleep(sleep)
+
+    target = sqlite3.connect(path)
+    try:
+        try:
+            source.backup(target, pages=pages, progress=step)
+        except RestartLimit:
+            source.backup(target)
+    finally:
+        target.close()
+    return progress["restarts"]
+
+
+def vacuum_into(source, path):
+    """Writes a compacted copy of source to path with VACUUM INTO"""
+
+    source.execute("VACUUM INTO ?", (path,))
+
+
+def verify(path):
+    """
+    Switches the snapshot at path to a rollback journal, so it is one
+    self-contained file, and runs PRAGMA integrity_check on it. Raises
+    BackupError with SQLite's findings when the check fails.
+    """
+
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute("PRAGMA journal_mode = DELETE").fetchall()
+        problems = [row[0] for row in
+                    connection.execute("PRAGMA integrity_check")]
+    except sqlite3.DatabaseError as error:
+        problems = [str(error)]
+    finally:
+        connection.close()
+    if problems != ["ok"]:
+        raise BackupError("{} failed its integrity check: {}".format(
+            path, "; ".join(problems[:10])))
+
+
+def compress_file(path, target):
+    """Gzips path into target and removes path"""
+
+    with open(path, "rb") as source, gzip.open(target, "wb") as stream:
+        shutil.copyfileobj(source, stream)
+    os.remove(path)
+
+
+def rotate(directory, stem, keep=KEEP):
+    """
+    Deletes all but the keep newest snapshots of stem in directory; keep
+    0 deletes none. Other files, partial snapshots included, are left
+    alone.
+
+    Returns:
+    List of deleted paths
+    """
+
+    pattern = snapshot_pattern(stem)
+    names = sorted(name for name in os.listdir(directory)
+                   if pattern.match(name))
+    expired = names[:-keep] if keep else []
+    paths = [os.path.join(directory, name) for name in expired]
+    for path in paths:
+        os.remove(path)
+    return paths
+
+
+def backup(directory, vacuum=False, compress=False, keep=KEEP,
+           pages=STEP_PAGES, sleep=STEP_SLEEP):
+    """
+    Snapshots models.DATABASE into directory, verifies the copy, then
+    rotates older snapshots. Runs on the open connection.
+
+    Parameters:
+    directory (str): where snapshots are kept, created if missing
+    vacuum (bool): write a compacted copy with VACUUM INTO
+    compress (bool): gzip the verified snapshot
+    keep (int): number of snapshots to keep, 0 keeps all
+    pages (int): pages copied per backup step
+    sleep (float): seconds to pause between steps
+
+    Returns:
+    (path of the snapshot, restarts, list of rotated paths)
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(models.DATABASE.database))[0]
+    now = datetime.datetime.now()
+    path = os.path.join(directory, snapshot_name(stem, now, compress))
+    if os.path.exists(path):
+        raise FileExistsError(path)
+    working = os.path.join(directory, snapshot_name(stem, now)) + \
+        PARTIAL_SUFFIX
+    finished = path + PARTIAL_SUFFIX
+    restarts = 0
+    try:
+        source = models.DATABASE.connection()
+        if vacuum:
+            vacuum_into(source, working)
+        else:
+            restarts = copy_pages(source, working, pages, sleep)
+        verify(working)
+        if compress:
+            compress_file(working, finished)
+        os.rename(finished, path)
+    finally:
+        for leftover in (working, finished, working + "-wal",
+                         working + "-shm", working + "-journal"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    return path, restarts, rotate(directory, stem, keep)
@@ -0,0 +1,83 @@
+import os
+import tempfile
+import threading
+
+import migrations
+import models
+
+
+class StatementCounter:
+    """Counts the SQL statements models.DATABASE executes while active
+
+    Attributes:
+    statements (list): SQL text of every statement run inside the block
+    """
+
+    def __init__(self, database=None):
+        self.database = database or models.DATABASE
+        self.statements = []
+
+    def __enter__(self):
+        self._execute_sql = self.database.execute_sql
+
+        def execute_sql(sql, *args, **kwargs):
+            self.statements.append(sql)
+            return self._execute_sql(sql, *args, **kwargs)
+
+        self.database.execute_sql = execute_sql
+        return self
+
+    def __exit__(self, *exc_info):
+        del self.database.execute_sql
+
+    def __len__(self):
+        return len(self.statements)
+
+
+class QueryMeter:
+    """Counts the SQL statements each thread executes while installed
+
+    Unlike StatementCounter it is safe to leave installed while several
+    threads share models.DATABASE, e.g. during a load test.
+    """
+
+    def __init__(self, database=None):
+        self.database = database or models.DATABASE
+        self._local = threading.local()
+
+    def install(self):
+        execute_sql = self.database.execute_sql
+
+        def counted(sql, *args, **kwargs):
+            self._local.count = getattr(self._local, "count", 0) + 1
+            return execute_sql(sql, *args, **kwargs)
+
+        self.database.execute_sql = counted
+
+    def uninstall(self):
+        del self.database.execute_sql
+
+    def reset(self):
+        """Starts counting again from zero on the calling thread"""
+
+        self._local.count = 0
+
+    @property
+    def count(self):
+        """Statements executed on the calling thread since the last reset"""
+
+        return getattr(self._local, "count", 0)
+
+
+def scratch_database():
+    """
+    Points models.DATABASE at a fresh journal in a temporary directory and
+    builds its tables. Returns the path of the new database file.
+    """
+
+    path = os.path.join(tempfile.mkdtemp(prefix="journal-bench-"),
+                        "journal.db")
+    models.init_database(path)
+    with models.DATABASE.connection_context():
+        migrations.migrate()
+    return path
@@ -0,0 +1,177 @@
+"""
+Fills a journal with synthetic data at scale using bulk inserts.
+
+Usage: python -m benchmark.generate --entries 100000 --users 500
+"""
+
+import argparse
+import datetime
+import itertools
+import random
+import time
+
+import models
+import passwords
+import rendering
+import transfer
+from benchmark import scratch_database
+
+
+WORDS = (
+    "python flask peewee sqlite index query cache cursor template jinja "
+    "decorator generator closure thread process socket http request route "
+    "session cookie bcrypt hash token queue worker async await pool lock "
+    "transaction commit rollback schema migration trigger search rank "
+    "vector matrix graph tree heap sort merge binary regex parser lexer"
+).split()
+BATCH_SIZE = 5000
+PASSWORD = "password"
+BCRYPT_ROUNDS = 4
+
+
+class Journal:
+    """Describes a generated journal so load tests can aim requests at it
+
+    Attributes:
+    path (str): database file
+    usernames (list): usernames, all with PASSWORD as password
+    emails (list): email addresses matching usernames
+    topics (list): tag topics, most popular first
+    slugs (list): a sample of entry slugs
+    """
+
+    def __init__(self, path, usernames, emails, topics, slugs):
+        self.path = path
+        self.usernames = usernames
+        self.emails = emails
+        self.topics = topics
+        self.slugs = slugs
+
+
+def zipf_weights(count, exponent):
+    """Cumulative Zipf weights for ranks 1..count"""
+
+    return list(itertools.accumulate(
+        1 / rank ** exponent for rank in range(1, count + 1)
+    ))
+
+
+def sentence(rng, words):
+    """A run of random words from WORDS"""
+
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def generate(entries=1000, users=50, tags=200, max_tags=4, max_resources=3,
+             zipf=1.1, seed=0, sample=1000):
+    """
+    Builds a fresh journal. Tags per entry follow a Zipf distribution so a
+    few topics are very popular, like a real journal. Rows get explicit
+    ids and go in with insert_many, one transaction per BATCH_SIZE entries.
+    Content is plain words, so its rendered HTML is written directly as
+    the single paragraph rendering.render would produce.
+
+    Returns:
+    Instance of Journal
+    """
+
+    rng = random.Random(seed)
+    path = scratch_database()
+    password = passwords.hash_password(PASSWORD, BCRYPT_ROUNDS)
+    usernames = ["user{}".format(i) for i in range(1, users + 1)]
+    emails = ["{}@example.com".format(name) for name in usernames]
+    topics = ["#{}{}".format(rng.choice(WORDS)[:8], i)
+              for i in range(1, tags + 1)]
+    weights = zipf_weights(tags, zipf)
+    today = datetime.date.today()
+
+    with models.DATABASE.atomic():
+        transfer.insert_rows(
+            models.User,
+            [models.User.id, models.User.username, models.User.email,
+             models.User.password],
+            [(i, name, email, password) for i, (name, email)
+             in enumerate(zip(usernames, emails), 1)],
+        )
+        transfer.insert_rows(
+            models.Tag,
+            [models.Tag.id, models.Tag.topic],
+            list(enumerate(topics, 1)),
+        )
+
+    slugs = []
+    resource_id = itertools.count(1)
+    with models.deferred_search_index(), models.deferred_rollups(), \
+            models.deferred_cache_events():
+        for start in range(1, entries + 1, BATCH_SIZE):
+            entry_rows, tag_rows, resource_rows = [], [], []
+            stop = min(start + BATCH_SIZE, entries + 1)
+            for entry_id in range(start, stop):
+                title = "{} {}".format(sentence(rng, 3), entry_id)
+                slug = "-".join(title.lower().split())
+                content = sentence(rng, rng.randint(30, 300))
+                entry_rows.append((
+                    entry_id, rng.randint(1, users), title, content,
+                    (today - datetime.timedelta(
+                        days=rng.randint(0, 3650))).isoformat(),
+                    rng.randint(1, 8), slug, "<p>{}</p>".format(content),
+                    rendering.shorten(content), rendering.RENDERER_VERSION,
+                ))
+                chosen = set(rng.choices(
+                    range(1, tags + 1), cum_weights=weights,
+                    k=rng.randint(0, max_tags),
+                ))
+                tag_rows.extend((entry_id, tag_id) for tag_id in chosen)
+                for _ in range(rng.randint(0, max_resources)):
+                    link = None
+                    if rng.random() < 0.7:
+                        link = "https://example.com/{}".format(
+                            next(resource_id))
+                    resource_rows.append((entry_id, sentence(rng, 4), link))
+                if len(slugs) < sample:
+                    slugs.append(slug)
+                elif rng.random() < sample / entry_id:
+                    slugs[rng.randrange(sample)] = slug
+            with models.DATABASE.atomic():
+                transfer.insert_rows(
+                    models.Entry,
+                    [models.Entry.id, models.Entry.author, models.Entry.title,
+                     models.Entry.content, models.Entry.date,
+                     models.Entry.time_spent, models.Entry.slug,
+                     models.Entry.content_html, models.Entry.excerpt,
+                     models.Entry.renderer_version],
+                    entry_rows,
+                )
+                transfer.insert_rows(
+                    models.EntryTag,
+                    [models.EntryTag.entry, models.EntryTag.tag],
+                    tag_rows,
+                )
+                transfer.insert_rows(
+                    models.Resource,
+                    [models.Resource.entry, models.Resource.title,
+                     models.Resource.link],
+                    resource_rows,
+                )
+    return Journal(path, usernames, emails, topics, slugs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--tags", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    started = time.perf_counter()
+    journal = generate(
+        entries=args.entries, users=args.users, tags=args.tags,
+        seed=args.seed,
+    )
+    elapsed = time.perf_counter() - started
+    print("{} entries in {:.1f}s ({:.0f} rows/sec) at {}".format(
+        args.entries, elapsed, args.entries / elapsed, journal.path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+Load-tests every route in app.py against a generated journal.
+
+Each worker thread logs in as its own user and replays a weighted mix of
+reads and writes through the Flask test client, recording latency and the
+number of SQL statements per request.
+
+Usage: python -m benchmark.load --entries 100000 --workers 8 --requests 5000
+       --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+
+import cache
+import models
+import pagination
+import ratelimit
+from app import create_app
+from benchmark import QueryMeter, generate
+
+
+ROUTES = {
+    "index": 25,
+    "index_deep": 10,
+    "tag": 15,
+    "detail": 25,
+    "search": 10,
+    "add": 4,
+    "edit": 4,
+    "delete": 2,
+    "login": 5,
+}
+OK_STATUSES = (200, 302, 304)
+
+
+class Worker(threading.Thread):
+    """Replays a weighted mix of requests as one logged in user"""
+
+    def __init__(self, number, app, journal, cursors, requests, meter,
+                 seed):
+        super().__init__(name="bench-{}".format(number))
+        self.number = number
+        self.journal = journal
+        self.cursors = cursors
+        self.requests = requests
+        self.meter = meter
+        self.rng = random.Random(seed + number)
+        self.client = app.test_client()
+        user = number % len(journal.emails)
+        self.email = journal.emails[user]
+        self.own_slugs = []
+        self.created = 0
+        self.samples = []
+
+    def login(self):
+        return self.client.post("/login", data={
+            "email": self.email, "password": generate.PASSWORD,
+        })
+
+    def entry_form(self, title):
+        return {
+            "title": title,
+            "content": generate.sentence(self.rng, 80),
+            "date": "2020-01-01",
+            "time_spent": str(self.rng.randint(1, 8)),
+            "tags": " ".join(self.rng.sample(self.journal.topics[:20], 3)),
+            "resources": "Docs https://example.com/docs\nA book",
+        }
+
+    def call(self, route):
+        """Issues one request for route, returning its response"""
+
+        if route in ("edit", "delete") and not self.own_slugs:
+            route = "add"
+        if route == "index":
+            return route, self.client.get("/")
+        if route == "index_deep":
+            return route, self.client.get(
+                "/?after=" + self.rng.choice(self.cursors))
+        if route == "tag":
+            topic = self.journal.topics[
+                min(int(self.rng.paretovariate(1)) - 1,
+                    len(self.journal.topics) - 1)]
+            return route, self.client.get(
+                "/entries/{}/topic".format(topic.replace("#", "%23")))
+        if route == "detail":
+            return route, self.client.get(
+                "/entries/" + self.rng.choice(self.journal.slugs))
+        if route == "search":
+            return route, self.client.get(
+                "/search?q=" + self.rng.choice(generate.WORDS))
+        if route == "add":
+            self.created += 1
+            title = "bench {} {}".format(self.number, self.created)
+            response = self.client.post(
+                "/entries/new", data=self.entry_form(title))
+            self.own_slugs.append("-".join(title.split()))
+            return route, response
+        if route == "edit":
+            slug = self.rng.choice(self.own_slugs)
+            return route, self.client.post(
+                "/entries/{}/edit".format(slug),
+                data=self.entry_form(slug.replace("-", " ")))
+        if route == "delete":
+            slug = self.own_slugs.pop(self.rng.randrange(len(self.own_slugs)))
+            return route, self.client.get("/entries/{}/delete".format(slug))
+        return route, self.login()
+
+    def run(self):
+        self.login()
+        names = list(ROUTES)
+        weights = list(ROUTES.values())
+        for _ in range(self.requests):
+            self.meter.reset()
+            started = time.perf_counter()
+            route, response = self.call(
+                self.rng.choices(names, weights=weights)[0])
+            elapsed = time.perf_counter() - started
+            self.samples.append((
+                route, elapsed, self.meter.count,
+                response.status_code in OK_STATUSES,
+            ))
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of already sorted values"""
+
+    if not values:
+        return 0.0
+    rank = max(1, int(round(fraction * len(values) + 0.5)))
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(samples, elapsed):
+    """Aggregates (route, seconds, statements, ok) samples by route"""
+
+    by_route = {}
+    for route, seconds, statements, ok in samples:
+        by_route.setdefault(route, []).append((seconds, statements, ok))
+    by_route["all"] = [sample[1:] for sample in samples]
+    results = {}
+    for route, rows in sorted(by_route.items()):
+        latencies = sorted(seconds for seconds, _, _ in rows)
+        results[route] = {
+            "requests": len(rows),
+            "errors": sum(1 for _, _, ok in rows if not ok),
+            "throughput_rps": len(rows) / elapsed,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "queries_per_request": (
+                sum(statements for _, statements, _ in rows) / len(rows)),
+        }
+    return results
+
+
+def print_results(results, baseline=None):
+    """Prints a table of results, with % change against a baseline run"""
+
+    columns = ("requests", "errors", "throughput_rps", "p50_ms", "p95_ms",
+               "p99_ms", "queries_per_request")
+    print("{:<12}".format("route") + "".join(
+        "{:>20}".format(column) for column in columns))
+    for route, result in results.items():
+        cells = []
+        for column in columns:
+            cell = "{:.1f}".format(result[column])
+            old = (baseline or {}).get(route, {}).get(column)
+            if old:
+                cell += " ({:+.0f}%)".format(
+                    (result[column] - old) / old * 100)
+            cells.append("{:>20}".format(cell))
+        print("{:<12}".format(route) + "".join(cells))
+
+
+def run(entries=1000, users=50, workers=4, requests=2000, page_cache=True,
+        seed=0):
+    """
+    Generates a journal and load-tests it
+
+    Returns:
+    Dictionary with the run's configuration and per-route results
+    """
+
+    journal = generate.generate(entries=entries, users=users, seed=seed)
+    cursors = [
+        pagination.encode_cursor(entry) for entry in models.Entry.select(
+            models.Entry.id, models.Entry.date
+        ).where(models.Entry.slug.in_(journal.slugs))
+    ]
+    models.DATABASE.close()
+
+    app = create_app({"DATABASE": journal.path, "WTF_CSRF_ENABLED": False,
+                      "SECRET_KEY": "benchmark",
+                      "BCRYPT_ROUNDS": generate.BCRYPT_ROUNDS})
+    ratelimit.IPS = ratelimit.TokenBucket(burst=float("inf"))
+    ratelimit.ACCOUNTS = ratelimit.TokenBucket(burst=float("inf"))
+    cache.PAGES.clear()
+    if not page_cache:
+        cache.PAGES.max_size = 0
+
+    meter = QueryMeter()
+    meter.install()
+    threads = [
+        Worker(number, app, journal, cursors, requests // workers, meter,
+               seed)
+        for number in range(workers)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    meter.uninstall()
+
+    samples = [sample for thread in threads for sample in thread.samples]
+    return {
+        "config": {
+            "entries": entries, "users": users, "workers": workers,
+            "requests": len(samples), "page_cache": page_cache,
+            "seed": seed, "seconds": elapsed,
+        },
+        "results": summarize(samples, elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--no-page-cache", dest="page_cache",
+                        action="store_false")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="save results as JSON here")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    args = parser.parse_args()
+
+    report = run(
+        entries=args.entries, users=args.users, workers=args.workers,
+        requests=args.requests, page_cache=args.page_cache, seed=args.seed,
+    )
+    baseline = None
+    if args.compare:
+        with open(args.compare) as previous:
+            baseline = json.load(previous)["results"]
+    print_results(report["results"], baseline)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Checks that every route in app.py stays within its SQL statement budget.
+
+Seeds a journal, requests each route with the page cache disabled and
+fails, printing the captured SQL, when a route runs more statements than
+its budget allows. Listing budgets hold for any page length, so an N+1
+crept in through a template shows up as soon as the page grows. Every
+route that opens the database spends one statement reading the cache
+event log, and writes one more applying their own events.
+
+Usage: python -m benchmark.query_budget, or python -m pytest
+tests/test_query_budget.py, which checks the same budgets.
+"""
+
+import sys
+
+import cache
+import ratelimit
+from app import create_app
+from benchmark import StatementCounter, generate
+
+
+BUDGETS = {
+    "index": 4,
+    "index_long": 4,
+    "index_deep": 4,
+    "tag": 5,
+    "search": 4,
+    "tags": 3,
+    "timeline": 5,
+    "archive": 5,
+    "archive_latest": 2,
+    "dashboard": 3,
+    "tag_dashboard": 3,
+    "detail": 6,
+    "edit_form": 5,
+    "edit": 18,
+    "add_form": 2,
+    "add": 14,
+    "delete": 9,
+    "login_form": 1,
+    "login": 2,
+    "signup_form": 1,
+    "logout": 2,
+    "metrics": 0,
+    "api_list": 3,
+    "api_list_long": 4,
+    "api_entry": 4,
+    "api_tags": 2,
+    "static": 0,
+}
+CONFIG = {
+    "WTF_CSRF_ENABLED": False,
+    "JOB_WORKERS": 0,
+    "SECRET_KEY": "benchmark",
+    "BCRYPT_ROUNDS": generate.BCRYPT_ROUNDS,
+}
+
+
+def requests(client, journal):
+    """Yields (budget name, response thunk) pairs covering every route"""
+
+    topic = journal.topics[0].replace("#", "%23")
+    slug = journal.slugs[0]
+    form = {
+        "title": "budget entry",
+        "content": "checking query budgets",
+        "date": "2020-01-01",
+        "time_spent": "1",
+        "tags": " ".join(journal.topics[:3]),
+        "resources": "Docs https://example.com\nA book",
+    }
+    login = {"email": journal.emails[0], "password": generate.PASSWORD}
+
+    yield "login_form", lambda: client.get("/login")
+    yield "signup_form", lambda: client.get("/signup")
+    yield "login", lambda: client.post("/login", data=login)
+    yield "index", lambda: client.get("/?size=5")
+    yield "index_long", lambda: client.get("/?size=100")
+    yield "index_deep", lambda: client.get("/?after=2000-01-01_1")
+    yield "tag", lambda: client.get("/entries/{}/topic".format(topic))
+    yield "search", lambda: client.get("/search?q=python")
+    yield "tags", lambda: client.get("/tags")
+    yield "timeline", lambda: client.get("/users/" + journal.usernames[0])
+    yield "archive_latest", lambda: client.get("/archive")
+    yield "archive", lambda: client.get("/archive/2020/1")
+    yield "dashboard", lambda: client.get("/dashboard?period=month")
+    yield "tag_dashboard", lambda: client.get(
+        "/dashboard/{}?period=day".format(topic))
+    yield "detail", lambda: client.get("/entries/" + slug)
+    yield "add_form", lambda: client.get("/entries/new")
+    yield "add", lambda: client.post("/entries/new", data=form)
+    yield "edit_form", lambda: client.get("/entries/budget-entry/edit")
+    yield "edit", lambda: client.post(
+        "/entries/budget-entry/edit",
+        data=dict(form, tags=" ".join(journal.topics[2:6]),
+                  resources="Another book"))
+    yield "delete", lambda: client.get("/entries/budget-entry/delete")
+    yield "metrics", lambda: client.get("/metrics")
+    yield "api_list", lambda: client.get("/api/entries?size=5")
+    yield "api_list_long", lambda: client.get(
+        "/api/entries?size=100&fields=slug,title,tags,resources")
+    yield "api_entry", lambda: client.get("/api/entries/" + slug)
+    yield "api_tags", lambda: client.get("/api/tags?size=20")
+    yield "static", lambda: client.get("/static/css/site.css")
+    yield "logout", lambda: client.get("/logout")
+
+
+def measure(client, journal):
+    """
+    Runs every route once with the rate limits and caches already out
+    of the way
+
+    Returns:
+    List of (name, statements, status code, captured SQL)
+    """
+
+    results = []
+    for name, request in requests(client, journal):
+        with StatementCounter() as counter:
+            response = request()
+        results.append(
+            (name, len(counter), response.status_code, counter.statements))
+    return results
+
+
+def check(entries=300):
+    """
+    Runs every route once and compares its statement count to BUDGETS
+
+    Returns:
+    List of (name, statements, budget, captured SQL) for routes over budget
+    """
+
+    journal = generate.generate(entries=entries, users=2)
+    journal.slugs.sort()
+    app = create_app(dict(CONFIG, DATABASE=journal.path))
+    ratelimit.IPS = ratelimit.TokenBucket(burst=float("inf"))
+    ratelimit.ACCOUNTS = ratelimit.TokenBucket(burst=float("inf"))
+    cache.PAGES.max_size = 0
+    cache.USERS.max_size = 0
+
+    failures = []
+    for name, statements, status, sql in measure(app.test_client(), journal):
+        if status >= 400:
+            failures.append((name, statements, BUDGETS[name], [
+                "HTTP {}".format(status)]))
+        elif statements > BUDGETS[name]:
+            failures.append((name, statements, BUDGETS[name], sql))
+        print("{:<14} {:>3} / {:<3}".format(name, statements, BUDGETS[name]))
+    return failures
+
+
+def main():
+    failures = check()
+    for name, statements, budget, sql in failures:
+        print("\n{} ran {} statements, budget is {}:".format(
+            name, statements, budget))
+        for line in sql:
+            print("    " + line)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Shows that handlers.sync_tags issues a constant number of statements
+however many tags an entry has.
+
+Usage: python -m benchmark.tag_sync
+"""
+
+import datetime
+import time
+
+import handlers
+import models
+from benchmark import StatementCounter, scratch_database
+
+
+TAG_COUNTS = (1, 10, 100, 500)
+
+
+def run():
+    """Syncs entries to growing tag sets and reports the statement count"""
+
+    scratch_database()
+    models.User.create_user(
+        username="bench", email="bench@example.com", password="password"
+    )
+    author = models.User.get(models.User.username == "bench")
+    print("{:>6} {:>12} {:>12} {:>10}".format(
+        "tags", "add stmts", "swap stmts", "ms"))
+    for count in TAG_COUNTS:
+        entry = models.Entry.create(
+            author=author,
+            title="bench {}".format(count),
+            content="benchmark",
+            date=datetime.date.today(),
+            time_spent=1,
+            slug="bench-{}".format(count),
+        )
+        first = ["#a{}".format(i) for i in range(count)]
+        second = ["#b{}".format(i) for i in range(count)]
+        start = time.perf_counter()
+        with StatementCounter() as added:
+            handlers.sync_tags(entry, first)
+        with StatementCounter() as swapped:
+            handlers.sync_tags(entry, second)
+        elapsed = (time.perf_counter() - start) * 1000
+        assert entry.tag_list == second
+        print("{:>6} {:>12} {:>12} {:>10.1f}".format(
+            count, len(added), len(swapped), elapsed))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,231 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import g, make_response, request, session
+from flask_login import current_user
+
+
+MAX_PAGES = 512
+TTL = 300
+LISTINGS = "listings"
+EVERYTHING = "*"
+MAX_USERS = 1024
+USER_TTL = 300
+
+
+class CachedPage:
+    """A rendered page held by PageCache
+
+    Attributes:
+    body (bytes): rendered response body
+    mimetype (str): mimetype of the response
+    etag (str): hash of the body
+    last_modified (int): time the page was rendered
+    tags (set): names of the data the page was rendered from
+    """
+
+    def __init__(self, body, mimetype, tags):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.last_modified = int(time.time())
+        self.tags = set(tags)
+
+
+class TTLCache:
+    """Bounded, thread-safe LRU mapping whose values expire after a TTL
+
+    Attributes:
+    max_size (int): values kept before the least recently used is dropped
+    ttl (int): seconds a value may be served before it has to be reloaded
+    hits (int): lookups answered from the cache
+    misses (int): lookups that found nothing fresh
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the fresh value for key, or None"""
+
+        with self._lock:
+            item = self._values.get(key)
+            if item is None or item[0] < time.monotonic():
+                self._values.pop(key, None)
+                self.misses += 1
+                return None
+            self._values.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        """Stores value under key, evicting the least recently used"""
+
+        with self._lock:
+            self._values[key] = (time.monotonic() + self.ttl, value)
+            self._values.move_to_end(key)
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+
+    def pop(self, key):
+        """Drops the value stored under key, if any"""
+
+        with self._lock:
+            self._values.pop(key, None)
+
+    def clear(self):
+        """Drops every value"""
+
+        with self._lock:
+            self._values.clear()
+
+
+class PageCache(TTLCache):
+    """TTLCache of rendered pages
+
+    Pages are tagged with the data they show so writes can drop exactly
+    the pages that are now out of date. Writes reach every process
+    through the cacheevent log, see apply.
+    """
+
+    def __init__(self, max_size=MAX_PAGES, ttl=TTL):
+        super().__init__(max_size, ttl)
+
+    def invalidate(self, *tags):
+        """Drops every page tagged with any of tags"""
+
+        tags = set(tags)
+        with self._lock:
+            for key in [key for key, (_, page) in self._values.items()
+                        if page.tags & tags]:
+                del self._values[key]
+
+
+PAGES = PageCache()
+USERS = TTLCache(MAX_USERS, USER_TTL)
+MONTHS = TTLCache(1, TTL)
+
+
+def entry_tag(entry_id):
+    """
+    Cache tag of the pages that show the entry with entry_id. The
+    triggers in models.CACHE_EVENT_TRIGGERS write the same names.
+    """
+
+    return "entry:{}".format(entry_id)
+
+
+def user_tag(user_id):
+    """Cache tag of the cached copy of the user with user_id"""
+
+    return "user:{}".format(user_id)
+
+
+position = None
+apply_lock = threading.Lock()
+
+
+def apply(new_position, tags):
+    """
+    Drops the pages, month counts and users named by tags, from cache
+    events up to new_position. EVERYTHING clears all three caches.
+    """
+
+    global position
+    tags = set(tags)
+    with apply_lock:
+        if EVERYTHING in tags:
+            PAGES.clear()
+            USERS.clear()
+            MONTHS.clear()
+        else:
+            PAGES.invalidate(*tags)
+            if LISTINGS in tags:
+                MONTHS.clear()
+            for tag in tags:
+                if tag.startswith("user:"):
+                    USERS.pop(int(tag[len("user:"):]))
+        if position is None or new_position > position:
+            position = new_position
+
+
+def reset():
+    """
+    Drops every cached value and forgets the cache event position, for a
+    process that switches to another database
+    """
+
+    global position
+    with apply_lock:
+        PAGES.clear()
+        USERS.clear()
+        MONTHS.clear()
+        position = None
+
+
+def store(target, key, value, stamp):
+    """
+    Sets key in target unless cache events were applied since stamp,
+    the position read before value was loaded. A value loaded across an
+    invalidation may predate the write, so it isn't kept.
+    """
+
+    with apply_lock:
+        if position == stamp:
+            target.set(key, value)
+
+
+def conditional(response, etag, last_modified=None):
+    """Adds validators to response and turns it into a 304 if they match"""
+
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def cached_page(*tags):
+    """
+    Serves a GET view from PAGES, keyed by path, query string and the
+    current user. Pages are tagged with tags, every entry loaded
+    through the request's identity map and any tags the view adds to
+    g.cache_tags. Pages carrying flashed messages, or rendered while a
+    write was being applied, are never cached.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if session.get("_flashes"):
+                return func(*args, **kwargs)
+            key = (request.full_path, current_user.get_id())
+            stamp = position
+            page = PAGES.get(key)
+            if page is not None:
+                response = make_response(page.body)
+                response.mimetype = page.mimetype
+                return conditional(response, page.etag, page.last_modified)
+            response = make_response(func(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            page = CachedPage(
+                response.get_data(),
+                response.mimetype,
+                set(tags) | g.get("cache_tags", set()) | {
+                    entry_tag(entry.id)
+                    for entry in g.get("entries", {}).values()},
+            )
+            store(PAGES, key, page, stamp)
+            return conditional(response, page.etag, page.last_modified)
+        return wrapper
+    return decorator
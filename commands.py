@@ -0,0 +1,216 @@
+import os
+import time
+
+import click
+from flask.cli import AppGroup
+
+import backup
+import dummy_data
+import jobs
+import migrations
+import models
+import transfer
+
+
+journal = AppGroup("journal", help="Maintenance commands for the journal.")
+
+
+def report(label, count, started):
+    """Echoes a row count with its throughput to stderr"""
+
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    click.echo(
+        "{} {} in {:.2f}s ({:.0f} rows/sec)".format(
+            label, count, elapsed, count / elapsed),
+        err=True,
+    )
+
+
+@journal.command("migrate")
+@click.option("--list", "show", is_flag=True,
+              help="Only list applied and pending migrations.")
+def migrate_command(show):
+    """Applies pending schema migrations in order."""
+
+    with models.DATABASE.connection_context():
+        if show:
+            done = migrations.applied_versions()
+            for version, name, _ in migrations.MIGRATIONS:
+                click.echo("{:>4} {:<8} {}".format(
+                    version, "applied" if version in done else "pending",
+                    name))
+            return
+        count = migrations.migrate(lambda version, name, seconds: click.echo(
+            "applied {} {} in {:.2f}s".format(version, name, seconds),
+            err=True))
+    click.echo("{} migrations applied".format(count), err=True)
+
+
+@journal.command("seed")
+def seed_command():
+    """Adds the demo user JaneDoe with three sample entries."""
+
+    with models.DATABASE.connection_context():
+        dummy_data.dummy_data()
+
+
+@journal.command("export")
+@click.argument("path", default="-")
+@click.option("--gzip/--no-gzip", "compress", default=None,
+              help="Compress the output. Defaults to on for .gz paths.")
+@click.option("--batch-size", default=transfer.BATCH_SIZE, show_default=True,
+              help="Rows read per query.")
+def export_command(path, compress, batch_size):
+    """Streams users and entries to PATH as NDJSON ("-" for stdout)."""
+
+    started = time.perf_counter()
+    with models.DATABASE.connection_context():
+        with transfer.open_stream(path, "w", compress) as stream:
+            count = transfer.export_journal(stream, batch_size)
+    report("exported", count, started)
+
+
+@journal.command("import")
+@click.argument("path", default="-")
+@click.option("--gzip/--no-gzip", "compress", default=None,
+              help="Decompress the input. Defaults to on for .gz paths.")
+@click.option("--batch-size", default=transfer.BATCH_SIZE, show_default=True,
+              help="Records inserted per transaction.")
+def import_command(path, compress, batch_size):
+    """Loads users and entries from an NDJSON file ("-" for stdin)."""
+
+    started = time.perf_counter()
+    with models.DATABASE.connection_context():
+        with transfer.open_stream(path, "r", compress) as stream:
+            users, entries, skipped = transfer.import_journal(
+                stream, batch_size)
+    report("imported users", users, started)
+    report("imported entries", entries, started)
+    if skipped:
+        click.echo("skipped {} entries already imported, by unknown "
+                   "authors or with taken titles".format(skipped), err=True)
+    if entries:
+        click.echo("related entries refresh queued for the job workers "
+                   "or flask journal drain", err=True)
+
+
+@journal.command("rebuild-tag-counts")
+def rebuild_tag_counts_command():
+    """Recounts entries per tag and deletes tags no entry uses."""
+
+    started = time.perf_counter()
+    with models.DATABASE.connection_context():
+        models.rebuild_tag_counts()
+        count = models.Tag.select().count()
+    report("counted tags", count, started)
+
+
+@journal.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Recomputes the time-spent rollups behind the dashboards."""
+
+    started = time.perf_counter()
+    with models.DATABASE.connection_context():
+        models.rebuild_rollups()
+        count = (models.UserRollup.select().count()
+                 + models.TagRollup.select().count())
+    report("rolled up", count, started)
+
+
+@journal.command("render")
+@click.option("--all", "everything", is_flag=True,
+              help="Re-render every entry, not only stale ones.")
+@click.option("--batch-size", default=transfer.BATCH_SIZE, show_default=True,
+              help="Entries rendered per transaction.")
+def render_command(everything, batch_size):
+    """Re-renders entry HTML made by an older renderer version."""
+
+    started = time.perf_counter()
+    with models.DATABASE.connection_context():
+        count = models.render_entries(batch_size, everything)
+    report("rendered", count, started)
+
+
+@journal.command("rebuild-related")
+@click.option("--batch-size", default=transfer.BATCH_SIZE, show_default=True,
+              help="Entries recomputed per statement.")
+def rebuild_related_command(batch_size):
+    """Recomputes the related entries shown on entry pages."""
+
+    started = time.perf_counter()
+    with models.DATABASE.connection_context():
+        count = models.rebuild_related(batch_size)
+    report("related", count, started)
+
+
+@journal.command("drain")
+@click.option("--retry-failed", is_flag=True,
+              help="Queue jobs that used up their attempts again first.")
+def drain_command(retry_failed):
+    """Runs every due background job, then exits."""
+
+    started = time.perf_counter()
+    with models.DATABASE.connection_context():
+        if retry_failed:
+            click.echo("requeued {} failed jobs".format(jobs.retry_failed()),
+                       err=True)
+        succeeded, failed = jobs.drain()
+        waiting = sum(jobs.counts().values())
+    report("ran", succeeded, started)
+    click.echo("{} failed, {} still queued or failed".format(failed, waiting),
+               err=True)
+
+
+@journal.command("jobs")
+def jobs_command():
+    """Lists background jobs by task and state."""
+
+    with models.DATABASE.connection_context():
+        for (name, state), count in jobs.counts().items():
+            click.echo("{:<12} {:<8} {}".format(name, state, count))
+
+
+@journal.command("worker")
+@click.option("--threads", default=jobs.WORKERS, show_default=True,
+              help="Worker threads in this process.")
+def worker_command(threads):
+    """Runs background jobs in the foreground until interrupted."""
+
+    pool = jobs.WorkerPool(threads)
+    pool.start()
+    click.echo("running {} job workers, Ctrl+C to stop".format(threads),
+               err=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pool.stop()
+
+
+@journal.command("backup")
+@click.argument("directory", default="backups")
+@click.option("--vacuum", is_flag=True,
+              help="Write a compacted copy with VACUUM INTO.")
+@click.option("--gzip/--no-gzip", "compress", default=False,
+              help="Compress the snapshot.")
+@click.option("--keep", default=backup.KEEP, show_default=True,
+              help="Snapshots to keep in DIRECTORY, 0 keeps all.")
+@click.option("--pages", default=backup.STEP_PAGES, show_default=True,
+              help="Pages copied per backup step.")
+@click.option("--sleep", default=backup.STEP_SLEEP, show_default=True,
+              help="Seconds to pause between backup steps.")
+def backup_command(directory, vacuum, compress, keep, pages, sleep):
+    """Snapshots the database into DIRECTORY while the app runs."""
+
+    started = time.perf_counter()
+    with models.DATABASE.connection_context():
+        try:
+            path, restarts, rotated = backup.backup(
+                directory, vacuum, compress, keep, pages, sleep)
+        except (backup.BackupError, FileExistsError) as error:
+            raise click.ClickException(str(error))
+    click.echo("backed up to {} in {:.2f}s ({} bytes, {} restarts)".format(
+        path, time.perf_counter() - started, os.path.getsize(path),
+        restarts), err=True)
+    for old in rotated:
+        click.echo("removed {}".format(old), err=True)
@@ -5,8 +5,8 @@ import models
 
 def dummy_data():
     """
-    Populates database with dummy data for testing. Set DUMMYDATA to 
-    False in app.py to prevent population.
+    Populates database with dummy data for testing. Only runs through
+    flask journal seed, never at startup.
     """
 
     try:
@@ -30,7 +30,7 @@ def dummy_data():
                     "eu fugiat nulla pariatur. Excepteur sint occaecat "
                     "cupidatat non proident, sunt in culpa qui officia "
                     "deserunt mollit anim id est laborum. ",
-                    date=datetime.datetime.now(),
+                    date=datetime.date.today(),
                     time_spent=i,
                 )
                 models.Tag.create(
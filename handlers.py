@@ -1,48 +1,62 @@
 import re
 
+from peewee import Case, Value, chunked
+
+import jobs
 import models
 
 
+TAG_PATTERN = re.compile(r"[#]\w+\b")
+URL_PATTERN = re.compile(r"(\b(http[s]*:\/\/|(www\.))(\S)*\b/?)")
+TITLE_STRIP_PATTERN = re.compile(r"[\b|]")
+
+
 def tag_handler(entry, form):
     """
     Processes and validates tag data from new entries and existing 
     entries being edited
     """
 
-    old_tags = entry.tags.split()
-    new_data = form.tags.data
-    tag_pattern = re.compile(r"[#]\w+\b")
-    new_tags = tag_pattern.findall(new_data)
-    if old_tags:
-        for tag in old_tags:
-            if tag not in new_tags:
-                try:
-                    q = models.Tag.get(
-                        models.Tag.topic == tag
-                    )
-                    entry_tag = models.EntryTag.get(
-                        models.EntryTag.tag == q,
-                        models.EntryTag.entry == entry,
+    sync_tags(entry, TAG_PATTERN.findall(form.tags.data))
+
+
+def sync_tags(entry, topics):
+    """
+    Makes the tags of entry exactly topics. The difference with the
+    current tags is worked out in memory and applied with one DELETE and
+    two bulk INSERTs in a single transaction, so the number of statements
+    doesn't grow with the number of tags.
+    """
+
+    wanted = list(dict.fromkeys(topics))
+    current = set(entry.tag_list)
+    removed = current.difference(wanted)
+    added = [topic for topic in wanted if topic not in current]
+    with models.DATABASE.atomic():
+        if removed:
+            models.EntryTag.delete().where(
+                models.EntryTag.entry == entry,
+                models.EntryTag.tag.in_(
+                    models.Tag.select(models.Tag.id).where(
+                        models.Tag.topic.in_(list(removed))
                     )
-                    entry_tag.delete_instance()
-                except:
-                    pass
-    for tag in new_tags:
-        try:
-            new_tag = models.Tag.get(
-                models.Tag.topic == tag
-            )
-        except models.DoesNotExist:
-            new_tag = models.Tag.create(
-                topic=tag
-            )
-        try:
-            models.EntryTag.create(
-                entry=entry,
-                tag=new_tag,
-            )
-        except models.IntegrityError:
-            pass
+                ),
+            ).execute()
+        if added:
+            models.Tag.insert_many(
+                [{"topic": topic} for topic in added]
+            ).on_conflict_ignore().execute()
+            models.EntryTag.insert_from(
+                models.Tag.select(Value(entry.id), models.Tag.id).where(
+                    models.Tag.topic.in_(added)
+                ).order_by(
+                    Case(models.Tag.topic, list(zip(added, range(len(added)))))
+                ),
+                [models.EntryTag.entry, models.EntryTag.tag],
+            ).on_conflict_ignore().execute()
+        if removed or added:
+            enqueue_related(entry)
+    entry.clear_tag_cache()
 
 
 def delete_tag_handler(entry):
@@ -50,11 +64,83 @@ def delete_tag_handler(entry):
     Deletes existing tags if blank tag field is submitted on edit view
     """
 
-    delete_all_tags_query = models.EntryTag.select().where(
-        models.EntryTag.entry == entry,
-    )
-    for instance in delete_all_tags_query:
-        instance.delete_instance()
+    with models.DATABASE.atomic():
+        if models.EntryTag.delete().where(
+            models.EntryTag.entry == entry,
+        ).execute():
+            enqueue_related(entry)
+    entry.clear_tag_cache()
+
+
+def enqueue_related(entry):
+    """
+    Queues a refresh of the related entries index for entry's new tags.
+    Several tag changes before a worker gets to it share one job.
+    """
+
+    jobs.enqueue("related", key="related:{}".format(entry.id),
+                 entry_id=entry.id)
+
+
+def refresh_related(entry_id):
+    """
+    Updates the related entries index for an entry whose tags changed.
+    The cache event triggers on relatedentry drop the pages showing the
+    lists that changed.
+    """
+
+    entry = models.Entry.get_or_none(models.Entry.id == entry_id)
+    if entry is None:
+        return
+    models.update_related(entry)
+
+
+def delete_entry_handler(entry):
+    """
+    Deletes entry and queues a refresh of the related entries lists that
+    showed it, so they are refilled rather than left one short
+    """
+
+    with models.DATABASE.atomic():
+        listers = [
+            entry_id for entry_id, in models.RelatedEntry.select(
+                models.RelatedEntry.entry
+            ).where(models.RelatedEntry.related == entry.id).tuples()
+        ]
+        entry.delete_instance()
+        if listers:
+            jobs.enqueue("related_lists", entry_ids=listers)
+
+
+def refresh_related_lists(entry_ids):
+    """Recomputes the related entries lists of entry_ids"""
+
+    models.refresh_related(entry_ids)
+
+
+def enqueue_related_rebuild(batch_size=500):
+    """
+    Queues a refresh of the related entries of every entry, one job per
+    batch_size entries, so a bulk change is followed by short write
+    transactions rather than one that rebuilds the whole index
+
+    Returns:
+    Number of jobs queued
+    """
+
+    ids = [entry_id for entry_id, in models.Entry.select(
+        models.Entry.id).order_by(models.Entry.id).tuples()]
+    batches = list(chunked(ids, batch_size))
+    for batch in batches:
+        jobs.enqueue("related_lists", entry_ids=batch)
+    return len(batches)
+
+
+def register_tasks():
+    """Registers the background job tasks defined here with jobs"""
+
+    jobs.task("related")(refresh_related)
+    jobs.task("related_lists")(refresh_related_lists)
 
 
 def resource_handler(entry, form):
@@ -63,55 +149,55 @@ def resource_handler(entry, form):
     entries being edited
     """
 
-    new_resources = form.resources.data.strip().splitlines()
-    old_resources = entry.resources.splitlines()
-    url_pattern = re.compile(
-        r"(\b(http[s]*:\/\/|(www\.))(\S)*\b/?)")
-
-    for resource in old_resources:
-        if resource not in new_resources:
-            url_match = url_pattern.search(resource)
-            title = re.sub(url_pattern, "", resource)
-            cleaned_title = cleaned_title = re.sub(
-                r"[\b|\b]", "", title)
-            try:
-                query = models.Resource.get(
-                    models.Resource.title == cleaned_title,
-                    models.Resource.entry == entry,
-                )
-                query.delete_instance()
-            except:
-                pass
-
-    for line in new_resources:
-        url_match = url_pattern.search(line)
-        title = re.sub(url_pattern, "", line)
-        cleaned_title = cleaned_title = re.sub(
-            r"[\b|\b]", "", title)
-        if url_match == None:
-            try:
-                models.Resource.get(
-                    models.Resource.title == cleaned_title,
-                    models.Resource.link == None,
-                )
-            except models.DoesNotExist:
-                models.Resource.create(
-                    entry=entry,
-                    title=cleaned_title,
-                    link=None,
-                )
+    sync_resources(entry, parse_resources(form.resources.data))
+
+
+def parse_resources(text):
+    """
+    Splits resource text into (title, link) pairs, one per line. The link
+    is the first URL found on the line, or None; the title is whatever is
+    left once the URL is removed.
+    """
+
+    resources = []
+    for line in text.strip().splitlines():
+        if not line.strip():
+            continue
+        url_match = URL_PATTERN.search(line)
+        title = TITLE_STRIP_PATTERN.sub("", URL_PATTERN.sub("", line))
+        resources.append((title, url_match[0] if url_match else None))
+    return resources
+
+
+def sync_resources(entry, resources):
+    """
+    Makes the resources of entry exactly the given (title, link) pairs.
+    Existing rows are diffed against them in memory, then removed rows go
+    in one DELETE and new ones in one bulk INSERT inside a transaction.
+    """
+
+    wanted = list(dict.fromkeys(resources))
+    kept = set()
+    removed = []
+    for resource in entry.resource_list:
+        key = (resource.title, resource.link)
+        if key in kept or key not in wanted:
+            removed.append(resource.id)
         else:
-            try:
-                models.Resource.get(
-                    models.Resource.title == cleaned_title,
-                    models.Resource.link == url_match[0],
-                )
-            except models.DoesNotExist:
-                models.Resource.create(
-                    entry=entry,
-                    title=cleaned_title,
-                    link=url_match[0],
-                )
+            kept.add(key)
+    added = [key for key in wanted if key not in kept]
+    with models.DATABASE.atomic():
+        if removed:
+            models.Resource.delete().where(
+                models.Resource.id.in_(removed)
+            ).execute()
+        if added:
+            models.Resource.insert_many(
+                [(entry.id, title, link) for title, link in added],
+                fields=[models.Resource.entry, models.Resource.title,
+                        models.Resource.link],
+            ).execute()
+    entry.clear_resource_cache()
 
 
 def delete_resource_handler(entry):
@@ -119,8 +205,7 @@ def delete_resource_handler(entry):
     Deletes existing resources if blank resource field is submitted on edit view
     """
 
-    delete_all_resources_query = models.Resource.select().where(
+    models.Resource.delete().where(
         models.Resource.entry == entry,
-    )
-    for instance in delete_all_resources_query:
-        instance.delete_instance()
+    ).execute()
+    entry.clear_resource_cache()
@@ -0,0 +1,284 @@
+"""
+Durable background jobs stored in the journal database.
+
+Views enqueue derived work, like refreshing the related entries index,
+inside the same transaction as the write it follows from, so a job
+exists exactly when its write committed. Worker threads claim due jobs
+with a lease and run each in its own transaction that also deletes the
+job, so a job's effects and its completion commit together. A worker
+that dies mid-job leaves the lease to expire and the job is run again;
+tasks must therefore be safe to repeat.
+
+Only work whose cost grows with the journal belongs here, like the
+related entries refresh, which scans every entry sharing a tag. The
+search index, tag counts, rollups and cache events stay in triggers:
+each costs a few indexed single-row statements, less than enqueueing,
+claiming and deleting a job would, and keeping them in the write's
+transaction means a user's next page already reflects their write.
+Cache events must commit with the write in any case, or another
+process could miss the invalidation.
+"""
+
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+
+from peewee import (CharField, DateTimeField, FloatField, IntegerField, Model,
+                    TextField)
+
+import models
+
+
+WORKERS = 2
+POLL_SECONDS = 5
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 5
+RETRY_SECONDS = 10
+QUEUED = "queued"
+FAILED = "failed"
+TASKS = {}
+
+log = logging.getLogger("journal.jobs")
+local = threading.local()
+
+
+class Job(Model):
+    """A unit of background work waiting to run
+
+    Parameters:
+    name (str): task in TASKS that runs the job
+    payload (str): JSON object of keyword arguments for the task
+    key (str): idempotency key; while a job with a key is waiting, jobs
+        enqueued with the same key are dropped
+    state (str): QUEUED or FAILED once MAX_ATTEMPTS runs have failed
+    attempts (int): number of times the job has been claimed
+    run_after (float): unix time the job is due, pushed back while a
+        worker holds it and after each failure
+    error (str): traceback of the last failure
+    created (datetime): when the job was enqueued
+
+    Returns:
+    Instance of Job
+    """
+
+    name = CharField()
+    payload = TextField(default="{}")
+    key = CharField(null=True, unique=True)
+    state = CharField(default=QUEUED)
+    attempts = IntegerField(default=0)
+    run_after = FloatField(default=time.time)
+    error = TextField(null=True)
+    created = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        database = models.DATABASE
+        indexes = (
+            (("state", "run_after"), False),
+        )
+
+
+def task(name):
+    """Registers the decorated function as the task for jobs named name"""
+
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+
+def enqueue(name, key=None, delay=0, **payload):
+    """
+    Adds a job for task name with payload as its keyword arguments. Call
+    it inside the transaction of the write the job derives from. Nothing
+    is added while a job with the same key is still waiting to run.
+    """
+
+    Job.insert(
+        name=name, payload=json.dumps(payload, sort_keys=True), key=key,
+        run_after=time.time() + delay,
+    ).on_conflict_ignore().execute()
+    local.enqueued = True
+
+
+def claim(now=None):
+    """
+    Takes the next due job, leasing it for LEASE_SECONDS. The claim is a
+    conditional UPDATE, so workers racing for the same job can't both win.
+    The key is released, so writes made while the job runs enqueue a
+    fresh job rather than being dropped.
+
+    Returns:
+    Instance of Job or None when nothing is due
+    """
+
+    now = time.time() if now is None else now
+    while True:
+        job = Job.select().where(
+            Job.state == QUEUED, Job.run_after <= now,
+        ).order_by(Job.run_after, Job.id).first()
+        if job is None:
+            return None
+        claimed = Job.update(
+            attempts=Job.attempts + 1, run_after=now + LEASE_SECONDS,
+            key=None,
+        ).where(
+            Job.id == job.id, Job.state == QUEUED,
+            Job.run_after == job.run_after,
+        ).execute()
+        if claimed:
+            job.attempts += 1
+            return job
+
+
+def run(job):
+    """
+    Runs a claimed job in one transaction with its deletion. A failure
+    rolls the work back and schedules a retry, RETRY_SECONDS doubling
+    each attempt, until MAX_ATTEMPTS marks the job FAILED.
+
+    Returns:
+    True if the job succeeded
+    """
+
+    try:
+        with models.DATABASE.atomic():
+            TASKS[job.name](**json.loads(job.payload))
+            Job.delete().where(Job.id == job.id).execute()
+    except Exception:
+        log.exception("Job %s (%s) failed on attempt %s",
+                      job.id, job.name, job.attempts)
+        failed = job.attempts >= MAX_ATTEMPTS
+        Job.update(
+            state=FAILED if failed else QUEUED,
+            run_after=time.time() + RETRY_SECONDS * 2 ** (job.attempts - 1),
+            error=traceback.format_exc(),
+        ).where(Job.id == job.id).execute()
+        return False
+    return True
+
+
+def drain(limit=None):
+    """
+    Runs due jobs on the calling thread until none are left, or limit
+    jobs have run. Jobs that fail are left for their retry time.
+
+    Returns:
+    (succeeded, failed) counts
+    """
+
+    succeeded = failed = 0
+    now = time.time()
+    while limit is None or succeeded + failed < limit:
+        job = claim(now)
+        if job is None:
+            break
+        if run(job):
+            succeeded += 1
+        else:
+            failed += 1
+    return succeeded, failed
+
+
+def retry_failed():
+    """
+    Queues every FAILED job again with a fresh set of attempts
+
+    Returns:
+    Number of jobs requeued
+    """
+
+    return Job.update(
+        state=QUEUED, attempts=0, run_after=time.time(),
+    ).where(Job.state == FAILED).execute()
+
+
+def counts():
+    """Number of jobs per (name, state)"""
+
+    query = Job.select(Job.name, Job.state, models.fn.COUNT(Job.id)).group_by(
+        Job.name, Job.state).order_by(Job.name, Job.state)
+    return {(name, state): count for name, state, count in query.tuples()}
+
+
+class WorkerPool:
+    """Daemon threads that drain the queue, woken by notify or every
+    POLL_SECONDS
+
+    Parameters:
+    size (int): number of worker threads
+    poll (float): seconds between checks for due jobs when idle
+
+    Returns:
+    Instance of WorkerPool
+    """
+
+    def __init__(self, size=WORKERS, poll=POLL_SECONDS):
+        self.size = size
+        self.poll = poll
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def start(self):
+        for number in range(self.size):
+            thread = threading.Thread(
+                target=self.work, name="journal-jobs-{}".format(number),
+                daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Lets running jobs finish, then ends the threads"""
+
+        self.stopping.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def work(self):
+        while not self.stopping.is_set():
+            self.wakeup.clear()
+            try:
+                with models.DATABASE.connection_context():
+                    while not self.stopping.is_set():
+                        job = claim()
+                        if job is None:
+                            break
+                        run(job)
+            except Exception:
+                log.exception("Job worker error")
+            self.wakeup.wait(self.poll)
+
+
+POOL = None
+POOL_PID = None
+
+
+def start_workers(size=WORKERS):
+    """
+    Starts the worker pool of this process, once. Safe to call after a
+    pre-fork server forks: each child gets its own threads.
+    """
+
+    global POOL, POOL_PID
+    if size <= 0 or POOL_PID == os.getpid():
+        return
+    POOL = WorkerPool(size)
+    POOL_PID = os.getpid()
+    POOL.start()
+
+
+def notify():
+    """
+    Wakes the worker pool if the calling thread enqueued jobs since the
+    last call. Call it once the enqueuing transaction has committed.
+    """
+
+    if getattr(local, "enqueued", False):
+        local.enqueued = False
+        if POOL is not None and POOL_PID == os.getpid():
+            POOL.wakeup.set()
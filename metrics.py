@@ -0,0 +1,199 @@
+import json
+import logging
+import threading
+import time
+
+from flask import current_app, request
+from jinja2 import Template
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_REQUEST_SECONDS = 0.0
+
+logger = logging.getLogger("journal.slow")
+_local = threading.local()
+
+
+class RequestStats:
+    """Time spent on one request, broken down by where it went
+
+    Attributes:
+    started (float): perf_counter value when the request began
+    statements (int): SQL statements executed
+    sql (float): seconds spent executing SQL
+    template (float): seconds spent rendering templates
+    bcrypt (float): seconds spent waiting on password hashing
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql = 0.0
+        self.template = 0.0
+        self.bcrypt = 0.0
+
+
+class RouteStats:
+    """Totals for every request served by one route
+
+    Attributes:
+    requests (int): requests served
+    buckets (list): request counts per latency bucket in BUCKETS
+    seconds (float): total request latency
+    statements (int): total SQL statements
+    sql (float): total seconds spent executing SQL
+    template (float): total seconds spent rendering templates
+    bcrypt (float): total seconds spent waiting on password hashing
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.buckets = [0] * len(BUCKETS)
+        self.seconds = 0.0
+        self.statements = 0
+        self.sql = 0.0
+        self.template = 0.0
+        self.bcrypt = 0.0
+
+    def add(self, seconds, stats):
+        self.requests += 1
+        self.seconds += seconds
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+        self.statements += stats.statements
+        self.sql += stats.sql
+        self.template += stats.template
+        self.bcrypt += stats.bcrypt
+
+
+ROUTES = {}
+_lock = threading.Lock()
+
+
+def current():
+    """RequestStats of the request running on this thread, or None"""
+
+    return getattr(_local, "stats", None)
+
+
+def record_query(seconds):
+    """Counts one SQL statement that took seconds"""
+
+    stats = current()
+    if stats is not None:
+        stats.statements += 1
+        stats.sql += seconds
+
+
+def record_bcrypt(seconds):
+    """Counts seconds spent waiting on password hashing"""
+
+    stats = current()
+    if stats is not None:
+        stats.bcrypt += seconds
+
+
+class TimedTemplate(Template):
+    """Jinja template that records how long rendering takes"""
+
+    def render(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            stats = current()
+            if stats is not None:
+                stats.template += time.perf_counter() - started
+
+
+def start_request():
+    """Begins collecting stats for the request on this thread"""
+
+    _local.stats = RequestStats()
+
+
+def finish_request(exception=None):
+    """Adds the finished request to its route's totals"""
+
+    stats = current()
+    if stats is None:
+        return
+    _local.stats = None
+    seconds = time.perf_counter() - stats.started
+    route = request.endpoint or "none"
+    with _lock:
+        ROUTES.setdefault(route, RouteStats()).add(seconds, stats)
+    threshold = current_app.config.get(
+        "SLOW_REQUEST_SECONDS", SLOW_REQUEST_SECONDS)
+    if threshold and seconds >= threshold:
+        logger.warning(json.dumps({
+            "event": "slow_request",
+            "route": route,
+            "method": request.method,
+            "path": request.full_path,
+            "seconds": round(seconds, 6),
+            "statements": stats.statements,
+            "sql_seconds": round(stats.sql, 6),
+            "template_seconds": round(stats.template, 6),
+            "bcrypt_seconds": round(stats.bcrypt, 6),
+        }))
+
+
+def init_app(app):
+    """Installs request timing and template timing on app"""
+
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(start_request)
+    app.teardown_request(finish_request)
+
+
+def render(counters=()):
+    """
+    Formats the collected totals as Prometheus text exposition. counters
+    is an iterable of (name, help, label, {label value: number}) extra
+    series, e.g. cache hit counts.
+    """
+
+    lines = []
+
+    def family(name, kind, help_text):
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, kind))
+
+    with _lock:
+        routes = sorted(ROUTES.items())
+        family("journal_request_duration_seconds", "histogram",
+               "Request latency by route.")
+        for route, totals in routes:
+            for bound, count in zip(BUCKETS, totals.buckets):
+                lines.append(
+                    'journal_request_duration_seconds_bucket'
+                    '{{route="{}",le="{}"}} {}'.format(route, bound, count))
+            lines.append(
+                'journal_request_duration_seconds_bucket'
+                '{{route="{}",le="+Inf"}} {}'.format(route, totals.requests))
+            lines.append('journal_request_duration_seconds_sum'
+                         '{{route="{}"}} {}'.format(route, totals.seconds))
+            lines.append('journal_request_duration_seconds_count'
+                         '{{route="{}"}} {}'.format(route, totals.requests))
+        for name, attribute, help_text in (
+            ("journal_sql_statements_total", "statements",
+             "SQL statements executed by route."),
+            ("journal_sql_seconds_total", "sql",
+             "Seconds spent executing SQL by route."),
+            ("journal_template_seconds_total", "template",
+             "Seconds spent rendering templates by route."),
+            ("journal_bcrypt_seconds_total", "bcrypt",
+             "Seconds spent waiting on password hashing by route."),
+        ):
+            family(name, "counter", help_text)
+            for route, totals in routes:
+                lines.append('{}{{route="{}"}} {}'.format(
+                    name, route, getattr(totals, attribute)))
+
+    for name, help_text, label, values in counters:
+        family(name, "counter", help_text)
+        for key, value in sorted(values.items()):
+            lines.append('{}{{{}="{}"}} {}'.format(name, label, key, value))
+    return "\n".join(lines) + "\n"
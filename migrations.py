@@ -0,0 +1,186 @@
+"""
+Versioned schema changes for the journal database.
+
+Each migration runs once, in version order, inside its own transaction,
+and is recorded in the schemaversion table along with how long it took.
+They only run through ``flask journal migrate``; starting the app never
+changes the schema. Migrations also bring databases created before this
+table existed up to date, so every step checks what is already there.
+"""
+
+import datetime
+import time
+
+from peewee import CharField, DateTimeField, FloatField, IntegerField, Model
+
+import jobs
+import models
+
+
+class SchemaVersion(Model):
+    """A migration that has been applied to the database
+
+    Parameters:
+    version (int): number of the migration in MIGRATIONS
+    name (str): description of the migration
+    applied (datetime): when the migration finished
+    seconds (float): how long the migration took
+
+    Returns:
+    Instance of SchemaVersion
+    """
+
+    version = IntegerField(primary_key=True)
+    name = CharField()
+    applied = DateTimeField(default=datetime.datetime.now)
+    seconds = FloatField()
+
+    class Meta:
+        database = models.DATABASE
+
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    """Registers the decorated function as migration number version"""
+
+    def register(func):
+        MIGRATIONS.append((version, name, func))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return func
+    return register
+
+
+@migration(1, "create tables")
+def create_tables():
+    """Creates the original tables, skipping any that already exist"""
+
+    for model in (models.User, models.Entry, models.Resource, models.Tag,
+                  models.EntryTag):
+        if not model.table_exists():
+            model.create_table()
+
+
+@migration(2, "full-text search index")
+def create_search_index():
+    """Builds EntrySearch and the triggers that keep it in sync"""
+
+    if not models.EntrySearch.table_exists():
+        models.EntrySearch.create_table()
+        models.rebuild_search_index()
+    models.create_triggers(models.SEARCH_TRIGGERS)
+
+
+@migration(3, "tag entry counts")
+def add_tag_counts():
+    """Adds Tag.entry_count, counts every tag and adds the count triggers"""
+
+    columns = [column.name for column in models.DATABASE.get_columns("tag")]
+    if "entry_count" not in columns:
+        models.DATABASE.execute_sql(
+            "ALTER TABLE tag ADD COLUMN entry_count INTEGER NOT NULL "
+            "DEFAULT 0")
+    models.Tag._schema.create_indexes(safe=True)
+    models.rebuild_tag_counts()
+    models.create_triggers(models.TAG_COUNT_TRIGGERS)
+
+
+@migration(4, "time spent rollups")
+def create_rollups():
+    """Builds UserRollup and TagRollup and the triggers that maintain them"""
+
+    models.DATABASE.create_tables(
+        [models.UserRollup, models.TagRollup], safe=True)
+    models.rebuild_rollups()
+    models.create_triggers(models.ROLLUP_TRIGGERS)
+
+
+@migration(5, "entry and resource indexes")
+def create_listing_indexes():
+    """Adds the (date, id), (author, date, id) and Resource indexes"""
+
+    models.Entry._schema.create_indexes(safe=True)
+    models.Resource._schema.create_indexes(safe=True)
+
+
+@migration(6, "rendered entry content")
+def add_rendered_content():
+    """Adds the rendered HTML and excerpt columns and renders every entry"""
+
+    columns = [column.name for column in models.DATABASE.get_columns("entry")]
+    for name, definition in (
+            ("content_html", "TEXT NOT NULL DEFAULT ''"),
+            ("excerpt", "TEXT NOT NULL DEFAULT ''"),
+            ("renderer_version", "INTEGER NOT NULL DEFAULT 0")):
+        if name not in columns:
+            models.DATABASE.execute_sql(
+                "ALTER TABLE entry ADD COLUMN {} {}".format(name, definition))
+    models.render_entries()
+
+
+@migration(7, "related entries")
+def create_related_entries():
+    """Builds the related entries index and its (tag, entry) lookup index"""
+
+    models.EntryTag._schema.create_indexes(safe=True)
+    models.DATABASE.create_tables([models.RelatedEntry], safe=True)
+    models.rebuild_related()
+
+
+@migration(8, "background jobs")
+def create_jobs():
+    """Creates the job queue table"""
+
+    models.DATABASE.create_tables([jobs.Job], safe=True)
+
+
+@migration(9, "cache events")
+def create_cache_events():
+    """Creates the cache event log and the triggers that write it"""
+
+    models.DATABASE.create_tables([models.CacheEvent], safe=True)
+    models.create_triggers(models.CACHE_EVENT_TRIGGERS)
+
+
+def applied_versions():
+    """Versions recorded in schemaversion, empty before the first run"""
+
+    if not SchemaVersion.table_exists():
+        return set()
+    return {version for version, in
+            SchemaVersion.select(SchemaVersion.version).tuples()}
+
+
+def pending():
+    """(version, name) of every migration not yet applied, in order"""
+
+    done = applied_versions()
+    return [(version, name) for version, name, _ in MIGRATIONS
+            if version not in done]
+
+
+def migrate(echo=None):
+    """
+    Applies every pending migration in order on the open connection.
+    echo, if given, is called with (version, name, seconds) after each.
+
+    Returns:
+    Number of migrations applied
+    """
+
+    models.DATABASE.create_tables([SchemaVersion], safe=True)
+    done = applied_versions()
+    count = 0
+    for version, name, func in MIGRATIONS:
+        if version in done:
+            continue
+        started = time.perf_counter()
+        with models.DATABASE.atomic():
+            func()
+            seconds = time.perf_counter() - started
+            SchemaVersion.create(version=version, name=name, seconds=seconds)
+        count += 1
+        if echo is not None:
+            echo(version, name, seconds)
+    return count
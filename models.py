@@ -1,11 +1,118 @@
-from flask_bcrypt import generate_password_hash
+import re
+import time
+from contextlib import contextmanager, nullcontext
+
 from flask_login import UserMixin
 from peewee import (Model, CharField, BooleanField, IntegerField, TextField,
-                    ForeignKeyField, DateField, IntegrityError, SqliteDatabase,
-                    DoesNotExist)
+                    ForeignKeyField, DateField, FloatField, IntegrityError,
+                    FieldAccessor, chunked, fn)
+from playhouse.pool import PooledDatabase, PooledSqliteDatabase
+from playhouse.sqlite_ext import FTS5Model, SearchField
+
+import cache
+import metrics
+import passwords
+import rendering
+
+
+DATABASE_NAME = "journal.db"
+MEMORY = ":memory:"
+MAX_CONNECTIONS = 8
+STALE_TIMEOUT = 300
+SLUG_ATTEMPTS = 5
+RELATED_LIMIT = 5
+RELATED_MAX_TAG_ENTRIES = 1000
+CACHE_EVENTS_KEPT = 10000
+CACHE_EVENT_PRUNE_EVERY = 1000
+CACHE_SYNC_LIMIT = 1000
+PRAGMAS = {
+    "foreign_keys": 1,
+    "journal_mode": "wal",
+    "busy_timeout": 5000,
+    "synchronous": "normal",
+    "cache_size": -16 * 1024,
+    "mmap_size": 64 * 1024 * 1024,
+}
+
+
+class JournalDatabase(PooledSqliteDatabase):
+    """
+    PooledSqliteDatabase that reports every statement to metrics and
+    begins transactions IMMEDIATE. Every transaction here writes; taking
+    the write lock up front makes a writer wait out busy_timeout instead
+    of failing with "database is locked" when it tries to upgrade a read
+    while the job workers or another process write.
+
+    An in-memory database (MEMORY) exists only as long as its one
+    connection, so it bypasses the pool: every thread shares a single
+    connection that is never closed as stale or returned to the pool.
+    """
+
+    _memory = None
+
+    def begin(self, lock_type="IMMEDIATE"):
+        super().begin(lock_type)
+
+    def _connect(self):
+        if self.database != MEMORY:
+            return super()._connect()
+        if self._memory is None:
+            self._memory = super(PooledDatabase, self)._connect()
+        return self._memory
 
+    def _close(self, conn, close_conn=False):
+        if conn is not self._memory:
+            super()._close(conn, close_conn)
+
+    def close_memory(self):
+        """Discards the in-memory database, if there is one"""
+
+        if self._memory is not None:
+            self._memory.close()
+            self._memory = None
+
+    def execute_sql(self, sql, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().execute_sql(sql, *args, **kwargs)
+        finally:
+            metrics.record_query(time.perf_counter() - started)
+
+
+DATABASE = JournalDatabase(
+    None,
+    pragmas=PRAGMAS,
+    max_connections=MAX_CONNECTIONS,
+    stale_timeout=STALE_TIMEOUT,
+    check_same_thread=False,
+)
+
+
+def init_database(path=DATABASE_NAME, max_connections=MAX_CONNECTIONS,
+                  pragmas=None):
+    """
+    Points DATABASE at the file path without opening a connection.
+    Connections are opened lazily by whichever process first runs a
+    query, so a server may call this before forking its workers. MEMORY
+    gives a fresh in-memory database shared by every thread, for tests.
+
+    Parameters:
+    path (str): SQLite database file
+    max_connections (int): size of this process's connection pool
+    pragmas (dict): PRAGMAS to override on every connection
+    """
 
-DATABASE = SqliteDatabase("journal.db", pragmas={'foreign_keys': 1})
+    if not DATABASE.deferred:
+        DATABASE.close_all()
+        DATABASE.close_memory()
+    cache.reset()
+    DATABASE.init(
+        path,
+        pragmas=dict(PRAGMAS, **(pragmas or {})),
+        max_connections=max_connections,
+        stale_timeout=STALE_TIMEOUT,
+        check_same_thread=False,
+    )
 
 
 class User(UserMixin, Model):
@@ -46,18 +153,38 @@ class User(UserMixin, Model):
         Instance of User
         """
 
+        password = passwords.hash_password(password)
         try:
             with DATABASE.transaction():
                 cls.create(
                     username=username,
                     email=email,
-                    password=generate_password_hash(password),
+                    password=password,
                     is_admin=admin
                 )
         except IntegrityError:
             pass
 
 
+class SourceAccessor(FieldAccessor):
+    """
+    Keeps the value a field had when its row was read, the first time
+    the field is assigned afterwards, as _loaded_<name> on the instance
+    """
+
+    def __set__(self, instance, value):
+        if self.name in instance.__data__ and self.name not in instance._dirty:
+            setattr(instance, "_loaded_" + self.name,
+                    instance.__data__[self.name])
+        super().__set__(instance, value)
+
+
+class SourceField(TextField):
+    """TextField that remembers its loaded value, see SourceAccessor"""
+
+    accessor_class = SourceAccessor
+
+
 class Entry(Model):
     """Journal entry of a learning moment
 
@@ -68,11 +195,18 @@ class Entry(Model):
     date (datetime): date of Entry
     time_spent (int): amount of time spent on learning content
     slug (str): url-friendly version of entry title
+    content_html (str): content rendered from Markdown to sanitized HTML
+    excerpt (str): plain-text start of the rendered content
+    renderer_version (int): rendering.RENDERER_VERSION that produced
+    content_html and excerpt
 
     Methods:
     create_entry : instantiates entry
+    listing : selects only the columns list views show
     tags : returns all tags related to entry in string format
+    tag_list : returns all tags related to entry as a list
     resources : returns all resources related to entry in string format
+    resource_list : returns all resources related to entry as a list
 
     Returns:
     Instance of Entry
@@ -84,17 +218,29 @@ class Entry(Model):
         on_delete="CASCADE",
     )
     title = CharField(max_length=32, unique=True)
-    content = TextField()
+    content = SourceField()
     date = DateField()
     time_spent = IntegerField()
     slug = CharField(unique=True)
+    content_html = TextField(default="")
+    excerpt = TextField(default="")
+    renderer_version = IntegerField(default=0)
 
     class Meta:
         database = DATABASE
+        indexes = (
+            (("date", "id"), False),
+            (("author", "date", "id"), False),
+        )
 
     @classmethod
     def create_entry(cls, author, title, content, date, time_spent):
-        """Instantiates Entry
+        """Instantiates Entry with one INSERT
+
+        The content is rendered once, before insert_unique picks the
+        slug. Views that insert inside a transaction build the Entry and
+        call render_content first instead, so the write lock isn't held
+        while Markdown renders.
 
         Parameters:
         author (foreign key): author of Entry
@@ -102,24 +248,111 @@ class Entry(Model):
         content (str): content of Entry
         date (datetime): date of Entry
         time_spent (int): amount of time spent on learning content
-        slug (str): url-friendly version of entry title
 
         Returns:
-        Instance of Entry
+        Instance of Entry with no tags or resources yet, raises
+        IntegrityError if the title is taken
         """
 
-        try:
-            with DATABASE.transaction():
-                cls.create(
-                    author=author,
-                    title=title,
-                    content=content,
-                    date=date,
-                    time_spent=time_spent,
-                    slug="-".join(title.lower().split()),
-                )
-        except IntegrityError:
-            return IntegrityError
+        entry = cls(author=author, title=title, content=content, date=date,
+                    time_spent=time_spent)
+        entry.render_content()
+        entry.insert_unique()
+        return entry
+
+    def insert_unique(self):
+        """
+        Inserts this new Entry with slug unique_slug(title). If another
+        request takes the same slug first, the INSERT is retried with the
+        next free suffix. A failed INSERT only undoes itself in SQLite, so
+        callers may wrap this in a larger transaction without a savepoint
+        per attempt. Raises IntegrityError if the title is taken.
+        """
+
+        for attempt in range(SLUG_ATTEMPTS):
+            self.slug = unique_slug(self.title)
+            try:
+                self.save(force_insert=True)
+            except IntegrityError as error:
+                if "entry.slug" not in str(error) or (
+                        attempt == SLUG_ATTEMPTS - 1):
+                    raise
+            else:
+                self._tag_cache = []
+                self._resource_cache = []
+                return
+
+    @classmethod
+    def listing(cls):
+        """
+        Selects the columns list views show, leaving out the content and
+        its HTML, which can be long
+        """
+
+        return cls.select(
+            cls.id, cls.author, cls.title, cls.date, cls.time_spent,
+            cls.slug, cls.excerpt,
+        )
+
+    _rendered_source = None
+    _loaded_content = None
+
+    def stored_source(self):
+        """
+        Content the content_html read with this Entry was rendered from,
+        or None if unknown or rendered by an older RENDERER_VERSION
+        """
+
+        if (self._pk is None or "content_html" not in self.__data__
+                or self.renderer_version != rendering.RENDERER_VERSION):
+            return None
+        if "content" in self._dirty:
+            return self._loaded_content
+        return self.content
+
+    def render_content(self):
+        """
+        Renders content into content_html and excerpt unless they already
+        hold the same text, rendered by this instance or read with it
+        """
+
+        if self.content in (self._rendered_source, self.stored_source()):
+            return
+        self.content_html = rendering.render(self.content)
+        self.excerpt = rendering.excerpt(self.content_html)
+        self.renderer_version = rendering.RENDERER_VERSION
+        self._rendered_source = self.content
+
+    def save(self, *args, **kwargs):
+        """
+        Renders the content if it changed and saves the Entry. Rendering
+        happens here, once per write, so views only read the stored HTML.
+        """
+
+        self.render_content()
+        return super().save(*args, **kwargs)
+
+    _tag_cache = None
+
+    @property
+    def tag_list(self):
+        """Hashtags related to an Entry instance
+
+        Loaded once per instance and memoized; prefetch_tags fills the
+        memo for a whole page of entries with a single query.
+
+        Returns:
+        List of the topics of all tags related to instance of Entry
+        """
+
+        if self._tag_cache is None:
+            query = Tag.select(Tag.topic).join(
+                EntryTag, on=EntryTag.tag
+            ).where(
+                EntryTag.entry == self
+            ).order_by(EntryTag.id)
+            self._tag_cache = [tag.topic for tag in query]
+        return self._tag_cache
 
     @property
     def tags(self):
@@ -133,16 +366,36 @@ class Entry(Model):
         Entry
         """
 
-        query = Tag.select().join(
-            EntryTag, on=EntryTag.tag
-        ).where(
-            EntryTag.entry == self
-        )
         tag_text = ""
-        for tag in query:
-            tag_text += tag.topic + " "
+        for topic in self.tag_list:
+            tag_text += topic + " "
         return tag_text
 
+    def clear_tag_cache(self):
+        """Forgets memoized tags so the next read reflects new writes"""
+
+        self._tag_cache = None
+
+    _resource_cache = None
+
+    @property
+    def resource_list(self):
+        """Resources related to an Entry instance
+
+        Loaded once per instance and memoized.
+
+        Returns:
+        List of Resource instances related to instance of Entry
+        """
+
+        if self._resource_cache is None:
+            self._resource_cache = list(
+                Resource.select().where(
+                    Resource.entry == self
+                ).order_by(Resource.id)
+            )
+        return self._resource_cache
+
     @property
     def resources(self):
         """Resources related to an Entry instance
@@ -156,17 +409,19 @@ class Entry(Model):
         Resource is placed on a new line.  
         """
 
-        query = Resource.select().where(
-            Resource.entry == self
-        )
         resource_text = ""
-        for resource in query:
+        for resource in self.resource_list:
             if resource.link:
                 resource_text += resource.title + resource.link + "\n"
             else:
                 resource_text += resource.title + "\n"
         return resource_text
 
+    def clear_resource_cache(self):
+        """Forgets memoized resources so the next read reflects new writes"""
+
+        self._resource_cache = None
+
 
 class Resource(Model):
     """Record of sources of knowledge
@@ -188,6 +443,9 @@ class Resource(Model):
 
     class Meta:
         database = DATABASE
+        indexes = (
+            (("entry", "title", "link"), False),
+        )
 
 
 class Tag(Model):
@@ -195,12 +453,15 @@ class Tag(Model):
 
     Parameters:
     topic (str): topic of the tag
+    entry_count (int): number of entries with the tag, maintained by the
+    triggers in TAG_COUNT_TRIGGERS
 
     Returns:
     Instance of Tag
     """
 
     topic = CharField(max_length=12, unique=True)
+    entry_count = IntegerField(default=0, index=True)
 
     class Meta:
         database = DATABASE
@@ -224,12 +485,876 @@ class EntryTag(Model):
         database = DATABASE
         indexes = (
             (("entry", "tag"), True),
+            (("tag", "entry"), False),
+        )
+
+
+class UserRollup(Model):
+    """Entries and hours one User logged in one day, week or month
+
+    Rows are kept current by the triggers in ROLLUP_TRIGGERS, so
+    dashboards read a handful of rows instead of grouping every Entry.
+
+    Parameters:
+    user (foreign key): User the totals belong to
+    period (str): "day", "week" or "month", see ROLLUP_PERIODS
+    start (date): first day of the period, weeks start on Monday
+    entries (int): number of entries dated in the period
+    time_spent (int): hours spent on those entries
+
+    Returns:
+    Instance of UserRollup
+    """
+
+    user = ForeignKeyField(model=User, backref="rollups", on_delete="CASCADE")
+    period = CharField(max_length=5)
+    start = DateField()
+    entries = IntegerField(default=0)
+    time_spent = IntegerField(default=0)
+
+    class Meta:
+        database = DATABASE
+        indexes = (
+            (("user", "period", "start"), True),
+        )
+
+
+class TagRollup(Model):
+    """Entries and hours logged under one Tag in one day, week or month
+
+    Parameters:
+    tag (foreign key): Tag the totals belong to
+    period (str): "day", "week" or "month", see ROLLUP_PERIODS
+    start (date): first day of the period, weeks start on Monday
+    entries (int): number of entries with the tag dated in the period
+    time_spent (int): hours spent on those entries
+
+    Returns:
+    Instance of TagRollup
+    """
+
+    tag = ForeignKeyField(model=Tag, backref="rollups", on_delete="CASCADE")
+    period = CharField(max_length=5)
+    start = DateField()
+    entries = IntegerField(default=0)
+    time_spent = IntegerField(default=0)
+
+    class Meta:
+        database = DATABASE
+        indexes = (
+            (("tag", "period", "start"), True),
         )
 
 
-def initialize_database():
-    """Build database and database tables"""
+class RelatedEntry(Model):
+    """One of the top RELATED_LIMIT entries sharing tags with an Entry
+
+    The score sums 1 / entry_count over the shared tags, so rare tags
+    count for more than popular ones. Kept current by update_related
+    whenever an entry's tags change.
+
+    Parameters:
+    entry (foreign key): Entry the recommendation is shown on
+    related (foreign key): recommended Entry
+    score (float): strength of the tag overlap
+
+    Returns:
+    Instance of RelatedEntry
+    """
+
+    entry = ForeignKeyField(model=Entry, backref="related_entries",
+                            on_delete="CASCADE")
+    related = ForeignKeyField(model=Entry, backref="related_to",
+                              on_delete="CASCADE")
+    score = FloatField()
+
+    class Meta:
+        database = DATABASE
+        indexes = (
+            (("entry", "score"), False),
+        )
+
+
+class CacheEvent(Model):
+    """A cache tag dropped by a committed write
+
+    Written by CACHE_EVENT_TRIGGERS in the same transaction as the
+    change, and read by sync_cache in every process, so an edit served
+    by one worker drops the cached pages of all of them.
+
+    Parameters:
+    tag (str): cache tag, e.g. cache.LISTINGS or cache.entry_tag(id)
+
+    Returns:
+    Instance of CacheEvent
+    """
+
+    tag = CharField()
+
+    class Meta:
+        database = DATABASE
+
+
+class EntrySearch(FTS5Model):
+    """Full-text index over Entry titles, content and Resource titles
+
+    Rows share their rowid with the Entry they index and are kept in sync
+    by the triggers in SEARCH_TRIGGERS, so every write path (including
+    bulk inserts that bypass the models) updates the index.
+
+    Parameters:
+    title (str): title of the Entry
+    content (str): content of the Entry
+    resources (str): titles of the Entry's Resources, space separated
+    """
+
+    title = SearchField()
+    content = SearchField()
+    resources = SearchField()
+
+    class Meta:
+        database = DATABASE
+        options = {"tokenize": "porter unicode61"}
+
+
+def create_triggers(triggers):
+    """
+    Creates the triggers missing from triggers, a sequence of (name,
+    definition) pairs where definition is the SQL after the name
+    """
+
+    for name, definition in triggers:
+        DATABASE.execute_sql("CREATE TRIGGER IF NOT EXISTS {} {}".format(
+            name, definition))
+
+
+def drop_triggers(triggers):
+    """Drops every trigger named in triggers"""
+
+    for name, _ in triggers:
+        DATABASE.execute_sql("DROP TRIGGER IF EXISTS {}".format(name))
+
+
+@contextmanager
+def deferred_triggers(triggers, rebuild):
+    """
+    Drops triggers for a bulk change, then calls rebuild to bring what
+    they maintain up to date in one pass and creates them again. Writes
+    from other connections aren't seen by the triggers meanwhile, so use
+    it inside the bulk change's transaction when the app may be running.
+    """
+
+    drop_triggers(triggers)
+    try:
+        yield
+    finally:
+        rebuild()
+        create_triggers(triggers)
+
+
+SEARCH_RESOURCES = (
+    "(SELECT group_concat(title, ' ') FROM resource WHERE entry_id = {0})"
+)
+
+SEARCH_TRIGGERS = (
+    ("entrysearch_entry_insert",
+     "AFTER INSERT ON entry BEGIN "
+     "INSERT INTO entrysearch (rowid, title, content, resources) "
+     "VALUES (new.id, new.title, new.content, ''); END"),
+
+    ("entrysearch_entry_update",
+     "AFTER UPDATE OF title, content ON entry BEGIN "
+     "UPDATE entrysearch SET title = new.title, content = new.content "
+     "WHERE rowid = new.id; END"),
+
+    ("entrysearch_entry_delete",
+     "AFTER DELETE ON entry BEGIN "
+     "DELETE FROM entrysearch WHERE rowid = old.id; END"),
+
+    ("entrysearch_resource_insert",
+     "AFTER INSERT ON resource BEGIN "
+     "UPDATE entrysearch SET resources = {} "
+     "WHERE rowid = new.entry_id; END".format(
+         SEARCH_RESOURCES.format("new.entry_id"))),
+
+    ("entrysearch_resource_update",
+     "AFTER UPDATE ON resource BEGIN "
+     "UPDATE entrysearch SET resources = {} "
+     "WHERE rowid = old.entry_id; "
+     "UPDATE entrysearch SET resources = {} "
+     "WHERE rowid = new.entry_id; END".format(
+         SEARCH_RESOURCES.format("old.entry_id"),
+         SEARCH_RESOURCES.format("new.entry_id"))),
+
+    ("entrysearch_resource_delete",
+     "AFTER DELETE ON resource BEGIN "
+     "UPDATE entrysearch SET resources = {} "
+     "WHERE rowid = old.entry_id; END".format(
+         SEARCH_RESOURCES.format("old.entry_id"))),
+)
+
+
+TAG_COUNT_TRIGGERS = (
+    ("tag_count_insert",
+     "AFTER INSERT ON entrytag BEGIN "
+     "UPDATE tag SET entry_count = entry_count + 1 WHERE id = new.tag_id; "
+     "END"),
+
+    ("tag_count_update",
+     "AFTER UPDATE OF tag_id ON entrytag BEGIN "
+     "UPDATE tag SET entry_count = entry_count + 1 WHERE id = new.tag_id; "
+     "UPDATE tag SET entry_count = entry_count - 1 WHERE id = old.tag_id; "
+     "DELETE FROM tag WHERE id = old.tag_id AND entry_count <= 0; END"),
+
+    ("tag_count_delete",
+     "AFTER DELETE ON entrytag BEGIN "
+     "UPDATE tag SET entry_count = entry_count - 1 WHERE id = old.tag_id; "
+     "DELETE FROM tag WHERE id = old.tag_id AND entry_count <= 0; END"),
+)
+
+
+def cache_event(*tags):
+    """Trigger statement logging tags, SQL expressions, as CacheEvents"""
+
+    return "INSERT INTO cacheevent (tag) VALUES {};".format(
+        ", ".join("({})".format(tag) for tag in tags))
+
+
+LISTINGS_EVENT = "'{}'".format(cache.LISTINGS)
+
+CACHE_EVENT_TRIGGERS = (
+    ("cache_entry_insert",
+     "AFTER INSERT ON entry BEGIN {} END".format(
+         cache_event(LISTINGS_EVENT, "'entry:' || new.id"))),
+
+    ("cache_entry_update",
+     "AFTER UPDATE ON entry BEGIN {} END".format(
+         cache_event(LISTINGS_EVENT, "'entry:' || new.id"))),
+
+    ("cache_entry_delete",
+     "AFTER DELETE ON entry BEGIN {} END".format(
+         cache_event(LISTINGS_EVENT, "'entry:' || old.id"))),
+
+    ("cache_entrytag_insert",
+     "AFTER INSERT ON entrytag BEGIN {} END".format(
+         cache_event(LISTINGS_EVENT, "'entry:' || new.entry_id"))),
+
+    ("cache_entrytag_delete",
+     "AFTER DELETE ON entrytag BEGIN {} END".format(
+         cache_event(LISTINGS_EVENT, "'entry:' || old.entry_id"))),
+
+    ("cache_resource_insert",
+     "AFTER INSERT ON resource BEGIN {} END".format(
+         cache_event("'entry:' || new.entry_id"))),
+
+    ("cache_resource_update",
+     "AFTER UPDATE ON resource BEGIN {} END".format(
+         cache_event("'entry:' || new.entry_id"))),
+
+    ("cache_resource_delete",
+     "AFTER DELETE ON resource BEGIN {} END".format(
+         cache_event("'entry:' || old.entry_id"))),
+
+    ("cache_related_insert",
+     "AFTER INSERT ON relatedentry BEGIN {} END".format(
+         cache_event("'entry:' || new.entry_id"))),
+
+    ("cache_related_delete",
+     "AFTER DELETE ON relatedentry BEGIN {} END".format(
+         cache_event("'entry:' || old.entry_id"))),
+
+    ("cache_user_update",
+     "AFTER UPDATE ON user BEGIN {} END".format(
+         cache_event("'user:' || new.id"))),
+
+    ("cache_user_delete",
+     "AFTER DELETE ON user BEGIN {} END".format(
+         cache_event("'user:' || old.id"))),
+
+    ("cache_event_prune",
+     "AFTER INSERT ON cacheevent "
+     "WHEN new.id % {} = 0 BEGIN "
+     "DELETE FROM cacheevent WHERE id <= new.id - {}; END".format(
+         CACHE_EVENT_PRUNE_EVERY, CACHE_EVENTS_KEPT)),
+)
+
+
+def deferred_cache_events():
+    """
+    Suspends per-row cache events for a bulk change, then logs a single
+    event that clears every cache. Does nothing before the migration
+    that adds the log.
+    """
+
+    if not CacheEvent.table_exists():
+        return nullcontext()
+    return deferred_triggers(
+        CACHE_EVENT_TRIGGERS, lambda: CacheEvent.create(tag=cache.EVERYTHING))
+
+
+def sync_cache():
+    """
+    Applies the cache events committed since this process last looked,
+    with one indexed read. A process that fell behind further than
+    CACHE_SYNC_LIMIT events, or past pruned ones, clears its caches.
+    """
+
+    position = cache.position
+    if position is None:
+        latest = CacheEvent.select(fn.MAX(CacheEvent.id)).scalar() or 0
+        cache.apply(latest, [cache.EVERYTHING])
+        return
+    events = list(CacheEvent.select(CacheEvent.id, CacheEvent.tag).where(
+        CacheEvent.id > position
+    ).order_by(CacheEvent.id).limit(CACHE_SYNC_LIMIT).tuples())
+    if not events:
+        return
+    latest = events[-1][0]
+    tags = {tag for _, tag in events}
+    if len(events) == CACHE_SYNC_LIMIT:
+        latest = CacheEvent.select(fn.MAX(CacheEvent.id)).scalar()
+        tags = {cache.EVERYTHING}
+    elif events[0][0] != position + 1:
+        tags = {cache.EVERYTHING}
+    cache.apply(latest, tags)
+
+
+RELATED_QUERY = (
+    "INSERT INTO relatedentry (entry_id, related_id, score) "
+    "SELECT entry_id, related_id, score FROM ("
+    "SELECT mine.entry_id AS entry_id, other.entry_id AS related_id, "
+    "sum(1.0 / tag.entry_count) AS score, row_number() OVER ("
+    "PARTITION BY mine.entry_id "
+    "ORDER BY sum(1.0 / tag.entry_count) DESC, other.entry_id DESC"
+    ") AS rank "
+    "FROM entrytag AS mine "
+    "JOIN tag ON tag.id = mine.tag_id "
+    "JOIN entrytag AS other "
+    "ON other.tag_id = mine.tag_id AND other.entry_id != mine.entry_id "
+    "WHERE mine.entry_id IN ({}) AND tag.entry_count <= ? "
+    "GROUP BY mine.entry_id, other.entry_id"
+    ") WHERE rank <= ?"
+)
+
+
+def refresh_related(entry_ids, batch_size=500):
+    """
+    Recomputes the related entries of every id in entry_ids with one
+    DELETE and one INSERT per batch_size ids. Tags on more than
+    RELATED_MAX_TAG_ENTRIES entries are skipped: they say little about
+    similarity and would make every write scan a large share of the
+    journal. Call inside a transaction so readers never see the lists
+    half rebuilt.
+    """
+
+    for batch in chunked(list(entry_ids), batch_size):
+        RelatedEntry.delete().where(RelatedEntry.entry.in_(batch)).execute()
+        DATABASE.execute_sql(
+            RELATED_QUERY.format(", ".join("?" * len(batch))),
+            batch + [RELATED_MAX_TAG_ENTRIES, RELATED_LIMIT],
+        )
+
+
+RELATED_CANDIDATES_QUERY = (
+    "SELECT other.entry_id FROM entrytag AS mine "
+    "JOIN tag ON tag.id = mine.tag_id "
+    "JOIN entrytag AS other "
+    "ON other.tag_id = mine.tag_id AND other.entry_id != mine.entry_id "
+    "WHERE mine.entry_id = ? AND tag.entry_count <= ? "
+    "GROUP BY other.entry_id "
+    "HAVING sum(1.0 / tag.entry_count) >= ("
+    "SELECT CASE WHEN count(*) < ? THEN 0 ELSE min(score) END "
+    "FROM relatedentry WHERE entry_id = other.entry_id)"
+)
+
+
+def update_related(entry):
+    """
+    Refreshes the related entries of entry after its tags changed, and
+    of every entry whose list showed it before or should show it now:
+    the entries sharing a tag with it whose list has room, or whose
+    lowest score its score with entry reaches. Runs in the caller's
+    transaction, like refresh_related.
+
+    Returns:
+    Set of ids of the other entries whose lists were refreshed
+    """
+
+    changed = {
+        entry_id for entry_id, in RelatedEntry.select(
+            RelatedEntry.entry
+        ).where(RelatedEntry.related == entry.id).tuples()
+    }
+    changed.update(
+        entry_id for entry_id, in DATABASE.execute_sql(
+            RELATED_CANDIDATES_QUERY,
+            (entry.id, RELATED_MAX_TAG_ENTRIES, RELATED_LIMIT),
+        )
+    )
+    refresh_related(changed | {entry.id})
+    return changed
+
+
+def rebuild_related(batch_size=500):
+    """
+    Recomputes the related entries of every Entry, batch_size entries
+    per statement
+
+    Returns:
+    Number of entries processed
+    """
+
+    count = 0
+    with DATABASE.atomic(), deferred_cache_events():
+        RelatedEntry.delete().execute()
+        ids = [entry_id for entry_id, in
+               Entry.select(Entry.id).order_by(Entry.id).tuples()]
+        for entry_ids in chunked(ids, batch_size):
+            DATABASE.execute_sql(
+                RELATED_QUERY.format(", ".join("?" * len(entry_ids))),
+                entry_ids + [RELATED_MAX_TAG_ENTRIES, RELATED_LIMIT],
+            )
+            count += len(entry_ids)
+    return count
+
+
+def related_entries(entry, limit=RELATED_LIMIT):
+    """Entries related to entry, best first, read with one indexed query
+
+    Parameters:
+    entry (Entry): entry the recommendations are for
+    limit (int): maximum number of entries
+
+    Returns:
+    List of Entry instances with the listing columns
+    """
+
+    return list(
+        Entry.listing().join(
+            RelatedEntry, on=(RelatedEntry.related == Entry.id)
+        ).where(
+            RelatedEntry.entry == entry.id
+        ).order_by(
+            RelatedEntry.score.desc(), RelatedEntry.related.desc()
+        ).limit(limit)
+    )
+
+
+def rebuild_tag_counts():
+    """
+    Recounts the entries of every tag from EntryTag and deletes tags that
+    no entry uses any more
+    """
+
+    with DATABASE.atomic():
+        DATABASE.execute_sql(
+            "UPDATE tag SET entry_count = "
+            "(SELECT count(*) FROM entrytag WHERE tag_id = tag.id)"
+        )
+        Tag.delete().where(Tag.entry_count == 0).execute()
+
+
+def deferred_tag_counts():
+    """
+    Suspends tag count maintenance for a bulk load, then recounts every
+    tag with one UPDATE
+    """
+
+    return deferred_triggers(TAG_COUNT_TRIGGERS, rebuild_tag_counts)
+
+
+ROLLUP_PERIODS = {
+    "day": "{}",
+    "week": "date({}, 'weekday 0', '-6 days')",
+    "month": "date({}, 'start of month')",
+}
+
+
+def rollup_add(table, column, key, date, hours, source="WHERE true"):
+    """
+    SQL adding one entry to every period of a rollup table. key, date and
+    hours are expressions over source, the rest of the SELECT.
+    """
+
+    return " ".join(
+        "INSERT INTO {table} ({column}, period, start, entries, time_spent) "
+        "SELECT {key}, '{period}', {start}, 1, {hours} {source} "
+        "ON CONFLICT ({column}, period, start) DO UPDATE SET "
+        "entries = entries + 1, "
+        "time_spent = time_spent + excluded.time_spent;".format(
+            table=table, column=column, key=key, period=period,
+            start=start.format(date), hours=hours, source=source)
+        for period, start in ROLLUP_PERIODS.items()
+    )
+
+
+def rollup_remove(table, column, match, date, hours):
+    """
+    SQL taking one entry out of every period of a rollup table, for the
+    rows whose column matches the condition match
+    """
+
+    return " ".join(
+        "UPDATE {table} SET entries = entries - 1, "
+        "time_spent = time_spent - {hours} "
+        "WHERE {column} {match} AND period = '{period}' "
+        "AND start = {start};".format(
+            table=table, column=column, match=match, period=period,
+            start=start.format(date), hours=hours)
+        for period, start in ROLLUP_PERIODS.items()
+    )
+
+
+ENTRY_TAGS = "(SELECT tag_id FROM entrytag WHERE entry_id = {}.id)"
+
+ROLLUP_TRIGGERS = (
+    ("rollup_entry_insert",
+     "AFTER INSERT ON entry BEGIN {} END".format(
+         rollup_add("userrollup", "user_id", "new.author_id", "new.date",
+                    "new.time_spent"))),
+
+    ("rollup_entry_update",
+     "AFTER UPDATE OF author_id, date, time_spent ON entry "
+     "WHEN old.author_id != new.author_id OR old.date != new.date "
+     "OR old.time_spent != new.time_spent BEGIN {} {} {} {} END".format(
+         rollup_remove("userrollup", "user_id", "= old.author_id",
+                       "old.date", "old.time_spent"),
+         rollup_add("userrollup", "user_id", "new.author_id", "new.date",
+                    "new.time_spent"),
+         rollup_remove("tagrollup", "tag_id",
+                       "IN " + ENTRY_TAGS.format("old"),
+                       "old.date", "old.time_spent"),
+         rollup_add("tagrollup", "tag_id", "tag_id", "new.date",
+                    "new.time_spent",
+                    "FROM entrytag WHERE entry_id = new.id"))),
+
+    # BEFORE, because the cascade deletes the entry's tags after the row
+    # is gone and the entrytag trigger can no longer see its date.
+    ("rollup_entry_delete",
+     "BEFORE DELETE ON entry BEGIN {} {} END".format(
+         rollup_remove("userrollup", "user_id", "= old.author_id",
+                       "old.date", "old.time_spent"),
+         rollup_remove("tagrollup", "tag_id",
+                       "IN " + ENTRY_TAGS.format("old"),
+                       "old.date", "old.time_spent"))),
+
+    ("rollup_entrytag_insert",
+     "AFTER INSERT ON entrytag BEGIN {} END".format(
+         rollup_add("tagrollup", "tag_id", "new.tag_id", "date",
+                    "time_spent", "FROM entry WHERE id = new.entry_id"))),
+
+    ("rollup_entrytag_update",
+     "AFTER UPDATE OF entry_id, tag_id ON entrytag BEGIN {} {} END".format(
+         rollup_remove(
+             "tagrollup", "tag_id", "= old.tag_id",
+             "(SELECT date FROM entry WHERE id = old.entry_id)",
+             "(SELECT time_spent FROM entry WHERE id = old.entry_id)"),
+         rollup_add("tagrollup", "tag_id", "new.tag_id", "date",
+                    "time_spent", "FROM entry WHERE id = new.entry_id"))),
+
+    ("rollup_entrytag_delete",
+     "AFTER DELETE ON entrytag BEGIN {} END".format(
+         rollup_remove(
+             "tagrollup", "tag_id", "= old.tag_id",
+             "(SELECT date FROM entry WHERE id = old.entry_id)",
+             "(SELECT time_spent FROM entry WHERE id = old.entry_id)"))),
+)
+
+
+def deferred_rollups():
+    """
+    Suspends rollup maintenance for a bulk load, then rebuilds the
+    rollups with one GROUP BY per period
+    """
+
+    return deferred_triggers(ROLLUP_TRIGGERS, rebuild_rollups)
+
+
+def rebuild_rollups():
+    """Recomputes UserRollup and TagRollup from every Entry"""
+
+    with DATABASE.atomic():
+        UserRollup.delete().execute()
+        TagRollup.delete().execute()
+        for period, start in ROLLUP_PERIODS.items():
+            DATABASE.execute_sql(
+                "INSERT INTO userrollup "
+                "(user_id, period, start, entries, time_spent) "
+                "SELECT author_id, ?, {}, count(*), sum(time_spent) "
+                "FROM entry GROUP BY 1, 3".format(start.format("date")),
+                (period,),
+            )
+            DATABASE.execute_sql(
+                "INSERT INTO tagrollup "
+                "(tag_id, period, start, entries, time_spent) "
+                "SELECT entrytag.tag_id, ?, {}, count(*), "
+                "sum(entry.time_spent) FROM entrytag "
+                "JOIN entry ON entry.id = entrytag.entry_id "
+                "GROUP BY 1, 3".format(start.format("entry.date")),
+                (period,),
+            )
+
+
+def time_rollups(period, limit, user=None, topic=None):
+    """Hours logged per period by a user or under a tag, newest first
+
+    Reads only the rollup tables, so the cost does not grow with the
+    number of entries.
+
+    Parameters:
+    period (str): a key of ROLLUP_PERIODS
+    limit (int): maximum number of periods
+    user (int): id of the User, or None to pass topic
+    topic (str): topic of the Tag
+
+    Returns:
+    List of UserRollup or TagRollup instances with entries
+    """
+
+    if user is not None:
+        query = UserRollup.select().where(UserRollup.user == user)
+        model = UserRollup
+    else:
+        query = TagRollup.select().join(Tag).where(Tag.topic == topic)
+        model = TagRollup
+    return list(query.where(
+        model.period == period, model.entries > 0
+    ).order_by(model.start.desc()).limit(limit))
+
+
+def deferred_search_index():
+    """
+    Suspends search index maintenance for a bulk load, then rebuilds the
+    index in one pass, which is much faster than a trigger per row
+    """
+
+    return deferred_triggers(SEARCH_TRIGGERS, rebuild_search_index)
+
+
+def rebuild_search_index():
+    """Repopulates EntrySearch from scratch for entries written before it"""
+
+    with DATABASE.atomic():
+        EntrySearch.delete().execute()
+        DATABASE.execute_sql(
+            "INSERT INTO entrysearch (rowid, title, content, resources) "
+            "SELECT id, title, content, coalesce({}, '') FROM entry".format(
+                SEARCH_RESOURCES.format("entry.id"))
+        )
+
+
+def month_counts():
+    """Entries per month across the journal, summed from UserRollup
+
+    Returns:
+    List of (first day of the month, entries) tuples, newest first
+    """
+
+    entries = fn.SUM(UserRollup.entries)
+    return list(
+        UserRollup.select(
+            UserRollup.start, entries
+        ).where(
+            UserRollup.period == "month"
+        ).group_by(
+            UserRollup.start
+        ).having(
+            entries > 0
+        ).order_by(
+            UserRollup.start.desc()
+        ).tuples()
+    )
+
+
+def render_entries(batch_size=500, everything=False):
+    """
+    Re-renders the stored HTML and excerpt of entries rendered by an
+    older RENDERER_VERSION, or of every entry. Works through the table in
+    id order, one transaction per batch_size entries.
+
+    Returns:
+    Number of entries rendered
+    """
+
+    count = 0
+    last = 0
+    while True:
+        query = Entry.select(Entry.id, Entry.content).where(Entry.id > last)
+        if not everything:
+            query = query.where(
+                Entry.renderer_version < rendering.RENDERER_VERSION)
+        rows = list(query.order_by(Entry.id).limit(batch_size).tuples())
+        if not rows:
+            return count
+        with DATABASE.atomic():
+            for entry_id, content in rows:
+                content_html = rendering.render(content)
+                Entry.update(
+                    content_html=content_html,
+                    excerpt=rendering.excerpt(content_html),
+                    renderer_version=rendering.RENDERER_VERSION,
+                ).where(Entry.id == entry_id).execute()
+        count += len(rows)
+        last = rows[-1][0]
+
+
+def slugify(title):
+    """url-friendly version of title"""
+
+    return "-".join(title.lower().split())
+
+
+def unique_slug(title, exclude=None):
+    """First free slug for title: slugify(title), then with -2, -3, ...
+
+    Every slug that could collide shares the prefix "<slug>-<digit>", so
+    they are all read with one range scan of the unique slug index.
+
+    Parameters:
+    title (str): title of the Entry
+    exclude (int): id of an Entry whose own slug counts as free
+
+    Returns:
+    Slug no other Entry uses
+    """
+
+    base = slugify(title)
+    suffix = re.compile(re.escape(base) + r"-(\d+)")
+    query = Entry.select(Entry.slug).where(
+        (Entry.slug == base)
+        | ((Entry.slug >= base + "-0") & (Entry.slug < base + "-:"))
+    )
+    if exclude is not None:
+        query = query.where(Entry.id != exclude)
+    taken = set()
+    for slug, in query.tuples():
+        match = suffix.fullmatch(slug)
+        if slug == base:
+            taken.add(1)
+        elif match and int(match.group(1)) > 1:
+            taken.add(int(match.group(1)))
+    number = 1
+    while number in taken:
+        number += 1
+    return base if number == 1 else "{}-{}".format(base, number)
+
+
+def popular_tags(limit):
+    """The most used tags, read from the maintained entry counts
+
+    Parameters:
+    limit (int): maximum number of tags
+
+    Returns:
+    List of Tag instances, most entries first
+    """
+
+    return list(
+        Tag.select().where(
+            Tag.entry_count > 0
+        ).order_by(
+            Tag.entry_count.desc(), Tag.topic
+        ).limit(limit)
+    )
+
+
+def tags_by_entry(entry_ids):
+    """Loads the tag topics of many entries with one query
+
+    Parameters:
+    entry_ids (iterable): ids of Entry instances
+
+    Returns:
+    Dictionary of entry id to a list of its tag topics
+    """
+
+    topics = {entry_id: [] for entry_id in entry_ids}
+    if not topics:
+        return topics
+    query = EntryTag.select(EntryTag.entry, Tag.topic).join(
+        Tag, on=EntryTag.tag
+    ).where(
+        EntryTag.entry.in_(list(topics))
+    ).order_by(EntryTag.id).tuples()
+    for entry_id, topic in query:
+        topics[entry_id].append(topic)
+    return topics
+
+
+def resources_by_entry(entry_ids):
+    """Loads the resources of many entries with one query
+
+    Parameters:
+    entry_ids (iterable): ids of Entry instances
+
+    Returns:
+    Dictionary of entry id to a list of its Resource instances
+    """
+
+    resources = {entry_id: [] for entry_id in entry_ids}
+    if not resources:
+        return resources
+    query = Resource.select().where(
+        Resource.entry.in_(list(resources))
+    ).order_by(Resource.id)
+    for resource in query:
+        resources[resource.entry_id].append(resource)
+    return resources
+
+
+def prefetch_tags(entries):
+    """Loads the tags of many entries with one query
+
+    Parameters:
+    entries (iterable): Entry instances, e.g. a page of the index
+
+    Returns:
+    List of the same Entry instances with their tag_list memo filled
+    """
+
+    entries = list(entries)
+    topics = tags_by_entry(entry.id for entry in entries)
+    for entry in entries:
+        entry._tag_cache = topics[entry.id]
+    return entries
+
+
+def prefetch_resources(entries):
+    """Loads the resources of many entries with one query
+
+    Parameters:
+    entries (iterable): Entry instances, e.g. a batch being exported
+
+    Returns:
+    List of the same Entry instances with their resource_list memo filled
+    """
+
+    entries = list(entries)
+    resources = resources_by_entry(entry.id for entry in entries)
+    for entry in entries:
+        entry._resource_cache = resources[entry.id]
+    return entries
+
+
+def load_entry(slug):
+    """Fetches an Entry together with everything its pages display
+
+    The author is joined into the entry query, then resources and tags
+    are each loaded with one more query, so the cost is three queries
+    no matter how the entry is rendered afterwards.
+
+    Parameters:
+    slug (str): url-friendly version of entry title
+
+    Returns:
+    Instance of Entry, raises DoesNotExist if there is none
+    """
 
-    DATABASE.connect()
-    DATABASE.create_tables([User, Entry, Resource, Tag, EntryTag], safe=True)
-    DATABASE.close()
+    entry = Entry.select(Entry, User).join(
+        User, on=Entry.author
+    ).where(
+        Entry.slug == slug
+    ).get()
+    prefetch_resources([entry])
+    prefetch_tags([entry])
+    return entry
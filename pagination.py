@@ -0,0 +1,147 @@
+import datetime
+
+from peewee import Tuple
+
+import models
+
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class Page:
+    """One page of a keyset-paginated Entry listing
+
+    Attributes:
+    entries (list): Entry instances on this page, newest first
+    next_cursor (str): cursor of the following (older) page, or None
+    prev_cursor (str): cursor of the preceding (newer) page, or None
+    """
+
+    def __init__(self, entries, next_cursor=None, prev_cursor=None):
+        self.entries = entries
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def encode_key(date, entry_id):
+    """Builds an opaque cursor from a (date, id) sort key"""
+
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+    return "{}_{}".format(date.isoformat(), entry_id)
+
+
+def encode_cursor(entry):
+    """Builds an opaque cursor from an Entry's (date, id) sort key"""
+
+    return encode_key(entry.date, entry.id)
+
+
+def decode_cursor(cursor):
+    """Parses a cursor back into its (date, id) sort key
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    date, _, entry_id = cursor.partition("_")
+    datetime.datetime.strptime(date, "%Y-%m-%d")
+    return date, int(entry_id)
+
+
+def page_size(value, default=PAGE_SIZE):
+    """
+    Clamps a requested page size to 1..MAX_PAGE_SIZE, using default when
+    value is missing or malformed
+    """
+
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        size = default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def seek(query, fields, after=None, before=None, size=PAGE_SIZE,
+         descending=True):
+    """
+    Applies keyset pagination to a query. Pages are walked with a row-value
+    comparison against the last seen key, so with an index on the key
+    fields every page is a range scan no matter how deep it is.
+
+    Parameters:
+    query (SelectQuery): query to page through, any ordering is replaced
+    fields (tuple): expressions making up the unique sort key
+    after (tuple): key of the last row on the previous page
+    before (tuple): key of the first row on the next page
+    size (int): maximum number of rows on the page
+    descending (bool): direction of the listing
+
+    Returns:
+    Tuple of the rows in listing order and whether there are more rows
+    past the page in the direction it was walked
+    """
+
+    key = Tuple(*fields)
+    forward = before is None
+    if not forward:
+        query = query.where(key > before if descending else key < before)
+    elif after is not None:
+        query = query.where(key < after if descending else key > after)
+    if forward == descending:
+        ordering = [field.desc() for field in fields]
+    else:
+        ordering = [field.asc() for field in fields]
+    rows = list(query.order_by(*ordering).limit(size + 1))
+    more = len(rows) > size
+    rows = rows[:size]
+    if not forward:
+        rows.reverse()
+    return rows, more
+
+
+def make_page(rows, more, after, before, encode):
+    """Wraps the result of seek in a Page with next and previous cursors"""
+
+    if before:
+        return Page(
+            rows,
+            next_cursor=encode(rows[-1]) if rows else None,
+            prev_cursor=encode(rows[0]) if more else None,
+        )
+    return Page(
+        rows,
+        next_cursor=encode(rows[-1]) if more else None,
+        prev_cursor=encode(rows[0]) if after and rows else None,
+    )
+
+
+def paginate(query, after=None, before=None, size=PAGE_SIZE):
+    """
+    Pages through an Entry query newest first, keyed on
+    (Entry.date, Entry.id) and backed by the index on those columns.
+
+    Parameters:
+    query (SelectQuery): Entry query, any existing ordering is replaced
+    after (str): cursor of the last entry on the previous page
+    before (str): cursor of the first entry on the next page
+    size (int): maximum number of entries on the page
+
+    Returns:
+    Instance of Page, raises ValueError for a malformed cursor
+    """
+
+    rows, more = seek(
+        query,
+        (models.Entry.date, models.Entry.id),
+        after=decode_cursor(after) if after else None,
+        before=decode_cursor(before) if before else None,
+        size=size,
+    )
+    return make_page(rows, more, after, before, encode_cursor)
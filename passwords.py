@@ -0,0 +1,104 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from flask_bcrypt import check_password_hash, generate_password_hash
+
+import metrics
+
+
+BCRYPT_ROUNDS = 12
+WORKERS = 2
+MAX_QUEUE = 16
+TIMEOUT = 30
+
+
+class Busy(Exception):
+    """
+    Raised when more password jobs are waiting than MAX_QUEUE allows, or
+    when one doesn't finish within TIMEOUT seconds
+    """
+
+
+_executor = ThreadPoolExecutor(
+    max_workers=WORKERS, thread_name_prefix="bcrypt"
+)
+_slots = threading.BoundedSemaphore(WORKERS + MAX_QUEUE)
+
+
+def configure(rounds=BCRYPT_ROUNDS, workers=WORKERS, max_queue=MAX_QUEUE,
+              timeout=TIMEOUT):
+    """
+    Sets the bcrypt cost and timeout, and resizes the worker pool when
+    workers or max_queue changed. Jobs already running finish on the old
+    pool.
+    """
+
+    global BCRYPT_ROUNDS, WORKERS, MAX_QUEUE, TIMEOUT, _executor, _slots
+    BCRYPT_ROUNDS = rounds
+    TIMEOUT = timeout
+    if (workers, max_queue) == (WORKERS, MAX_QUEUE):
+        return
+    WORKERS = workers
+    MAX_QUEUE = max_queue
+    _executor.shutdown(wait=False)
+    _executor = ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="bcrypt"
+    )
+    _slots = threading.BoundedSemaphore(workers + max_queue)
+
+
+def run(func, *args):
+    """
+    Runs func on the bcrypt worker pool and waits for its result. bcrypt
+    releases the GIL, so only WORKERS cores are ever spent hashing while
+    other requests keep being served; once WORKERS + MAX_QUEUE jobs are in
+    flight, further calls fail fast with Busy instead of piling up. A job
+    still waiting after TIMEOUT seconds raises Busy too.
+    """
+
+    slots = _slots
+    if not slots.acquire(blocking=False):
+        raise Busy("Too many password checks are waiting.")
+    started = time.perf_counter()
+    try:
+        future = _executor.submit(func, *args)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    try:
+        return future.result(timeout=TIMEOUT)
+    except TimeoutError:
+        raise Busy("A password check took too long.")
+    finally:
+        metrics.record_bcrypt(time.perf_counter() - started)
+
+
+def hash_password(password, rounds=None):
+    """Hashes password with bcrypt at BCRYPT_ROUNDS (or rounds) cost"""
+
+    return run(
+        generate_password_hash, password, rounds or BCRYPT_ROUNDS
+    ).decode("utf-8")
+
+
+def check_password(pw_hash, password):
+    """Checks password against a bcrypt hash"""
+
+    return run(check_password_hash, pw_hash, password)
+
+
+def rounds_of(pw_hash):
+    """Reads the cost a bcrypt hash was made with, e.g. 12 for $2b$12$..."""
+
+    try:
+        return int(pw_hash.split("$")[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def needs_rehash(pw_hash):
+    """Whether a hash was made with a cost other than BCRYPT_ROUNDS"""
+
+    return rounds_of(pw_hash) != BCRYPT_ROUNDS
@@ -0,0 +1,48 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+RATE = 0.2
+BURST = 5
+MAX_KEYS = 10000
+
+
+class TokenBucket:
+    """Token-bucket limiter keyed by client, e.g. an IP address or email
+
+    Every key starts with burst tokens and regains rate tokens a second.
+    Each attempt spends one token and is refused when none are left. The
+    least recently seen keys are forgotten beyond max_keys.
+
+    Attributes:
+    rate (float): tokens regained per second
+    burst (int): most tokens a key can hold
+    max_keys (int): keys tracked at once
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, max_keys=MAX_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """Spends a token for key, returning False if there was none"""
+
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed
+
+
+IPS = TokenBucket()
+ACCOUNTS = TokenBucket()
@@ -0,0 +1,67 @@
+import html
+import re
+
+import bleach
+import markdown
+
+
+RENDERER_VERSION = 1
+EXCERPT_LENGTH = 200
+EXTENSIONS = ("fenced_code", "codehilite", "tables", "sane_lists")
+EXTENSION_CONFIGS = {"codehilite": {"css_class": "highlight",
+                                    "guess_lang": False}}
+ALLOWED_TAGS = bleach.sanitizer.ALLOWED_TAGS + [
+    "p", "br", "hr", "pre", "span", "div", "del", "img",
+    "h1", "h2", "h3", "h4", "h5", "h6",
+    "table", "thead", "tbody", "tr", "th", "td",
+]
+ALLOWED_ATTRIBUTES = {
+    "a": ["href", "title"],
+    "img": ["src", "alt", "title"],
+    "span": ["class"],
+    "div": ["class"],
+    "code": ["class"],
+    "th": ["align"],
+    "td": ["align"],
+}
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def render(text):
+    """
+    Renders Markdown text to sanitized HTML. Fenced code blocks are
+    highlighted by Pygments; raw HTML outside ALLOWED_TAGS is escaped.
+
+    Bump RENDERER_VERSION whenever this changes its output so
+    ``flask journal render`` refreshes stored entries.
+    """
+
+    converted = markdown.markdown(
+        text, extensions=list(EXTENSIONS),
+        extension_configs=EXTENSION_CONFIGS,
+    )
+    return bleach.clean(
+        converted, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES,
+    )
+
+
+def shorten(text, length=EXCERPT_LENGTH):
+    """
+    Collapses whitespace in plain text and cuts it at the last word that
+    fits in length characters
+    """
+
+    text = WHITESPACE_PATTERN.sub(" ", text).strip()
+    if len(text) <= length:
+        return text
+    cut = text[:length + 1]
+    if " " in cut:
+        cut = cut.rsplit(" ", 1)[0]
+    return cut[:length].rstrip(" .,;:") + "…"
+
+
+def excerpt(rendered):
+    """Plain-text excerpt of HTML produced by render"""
+
+    return shorten(html.unescape(
+        bleach.clean(rendered, tags=[], strip=True)))
@@ -0,0 +1,101 @@
+import re
+
+from markupsafe import Markup, escape
+from peewee import fn
+
+import models
+import pagination
+
+
+TERM_PATTERN = re.compile(r"\w+")
+HIGHLIGHT_OPEN = "\x02"
+HIGHLIGHT_CLOSE = "\x03"
+SNIPPET_TOKENS = 24
+
+
+def match_expression(text):
+    """
+    Turns free text from the search box into an FTS5 query. Every word is
+    quoted so FTS5 operators typed by users can't cause syntax errors, and
+    the words are ANDed together.
+
+    Returns None when there is nothing to search for.
+    """
+
+    terms = TERM_PATTERN.findall(text or "")
+    if not terms:
+        return None
+    return " ".join('"{}"'.format(term) for term in terms)
+
+
+def encode_cursor(entry):
+    """Builds an opaque cursor from a result's (score, id) sort key"""
+
+    return "{!r}_{}".format(entry.score, entry.id)
+
+
+def decode_cursor(cursor):
+    """
+    Parses a cursor back into its (score, id) sort key. Raises ValueError
+    if the cursor is malformed.
+    """
+
+    score, _, entry_id = cursor.rpartition("_")
+    return float(score), int(entry_id)
+
+
+def highlight(snippet):
+    """Escapes a snippet and marks up the matched terms"""
+
+    return Markup(
+        str(escape(snippet or ""))
+        .replace(HIGHLIGHT_OPEN, "<mark>")
+        .replace(HIGHLIGHT_CLOSE, "</mark>")
+    )
+
+
+def search_entries(text, after=None, before=None,
+                   size=pagination.PAGE_SIZE):
+    """
+    Finds entries matching text, best matches first. Matching is an FTS5
+    index lookup, ranking is bm25 and results are keyset-paginated on
+    (score, Entry.id).
+
+    Parameters:
+    text (str): words to search for
+    after (str): cursor of the last result on the previous page
+    before (str): cursor of the first result on the next page
+    size (int): maximum number of results on the page
+
+    Returns:
+    Instance of Page whose entries carry the listing columns plus score
+    and a highlighted snippet, raises ValueError for a malformed cursor
+    """
+
+    expression = match_expression(text)
+    if expression is None:
+        return pagination.Page([])
+    score = models.EntrySearch.bm25()
+    query = models.Entry.listing().select_extend(
+        score.alias("score"),
+        fn.snippet(
+            models.EntrySearch._meta.entity, -1, HIGHLIGHT_OPEN,
+            HIGHLIGHT_CLOSE, "...", SNIPPET_TOKENS
+        ).alias("snippet"),
+    ).join(
+        models.EntrySearch,
+        on=(models.EntrySearch.rowid == models.Entry.id),
+    ).where(
+        models.EntrySearch.match(expression)
+    )
+    rows, more = pagination.seek(
+        query,
+        (score, models.Entry.id),
+        after=decode_cursor(after) if after else None,
+        before=decode_cursor(before) if before else None,
+        size=size,
+        descending=False,
+    )
+    for entry in rows:
+        entry.snippet = highlight(entry.snippet)
+    return pagination.make_page(rows, more, after, before, encode_cursor)
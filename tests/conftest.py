@@ -0,0 +1,35 @@
+import pytest
+
+import migrations
+import models
+import ratelimit
+from app import create_app
+from tests.helpers import make_user
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """App on a fresh in-memory journal with fast bcrypt and fresh limits"""
+
+    monkeypatch.setattr(ratelimit, "IPS", ratelimit.TokenBucket())
+    monkeypatch.setattr(ratelimit, "ACCOUNTS", ratelimit.TokenBucket())
+    app = create_app({
+        "DATABASE": models.MEMORY,
+        "TESTING": True,
+        "WTF_CSRF_ENABLED": False,
+        "BCRYPT_ROUNDS": 4,
+    })
+    migrations.migrate()
+    yield app
+    models.DATABASE.close()
+    models.DATABASE.close_memory()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def user(app):
+    return make_user()
@@ -0,0 +1,35 @@
+import datetime
+
+import handlers
+import models
+
+
+PASSWORD = "password"
+
+
+def make_user(name="alice"):
+    """Creates a user called name with PASSWORD and returns it"""
+
+    models.User.create_user(
+        username=name, email=name + "@example.com", password=PASSWORD)
+    return models.User.get(models.User.username == name)
+
+
+def make_entry(author, title, content="Some notes", tags=(), resources=(),
+               date=datetime.date(2020, 1, 1), time_spent=1):
+    """Creates an entry with its tags and (title, link) resources"""
+
+    with models.DATABASE.atomic():
+        entry = models.Entry.create_entry(
+            author=author, title=title, content=content, date=date,
+            time_spent=time_spent)
+        handlers.sync_tags(entry, list(tags))
+        handlers.sync_resources(entry, list(resources))
+    return entry
+
+
+def login(client, user):
+    """Logs client in as user"""
+
+    return client.post("/login", data={
+        "email": user.email, "password": PASSWORD})
@@ -0,0 +1,77 @@
+import pytest
+
+from tests.helpers import make_entry
+
+
+@pytest.fixture
+def entry(user):
+    return make_entry(user, "First", content="Hello *world*",
+                      tags=["#python", "#flask"],
+                      resources=[("Docs", "https://example.com")])
+
+
+def test_listing_is_revalidated_with_etag(client, entry):
+    first = client.get("/api/entries")
+    assert first.status_code == 200
+    assert first.headers["ETag"]
+    again = client.get("/api/entries",
+                       headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304
+    assert again.get_data() == b""
+
+
+def test_write_changes_the_listing_etag(client, user, entry):
+    etag = client.get("/api/entries").headers["ETag"]
+    make_entry(user, "Second")
+    response = client.get("/api/entries", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert [record["title"] for record in response.get_json()["entries"]] \
+        == ["Second", "First"]
+
+
+def test_entry_is_revalidated_with_etag(client, entry):
+    first = client.get("/api/entries/" + entry.slug)
+    assert first.get_json()["html"] == "<p>Hello <em>world</em></p>"
+    again = client.get("/api/entries/" + entry.slug,
+                       headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304
+
+
+def test_fields_narrow_the_records(client, entry):
+    body = client.get("/api/entries?fields=slug,tags,resources").get_json()
+    assert body["entries"] == [{
+        "slug": entry.slug,
+        "tags": ["#python", "#flask"],
+        "resources": [{"title": "Docs", "link": "https://example.com"}],
+    }]
+
+
+def test_unknown_fields_are_refused(client, entry):
+    response = client.get("/api/entries?fields=slug,password")
+    assert response.status_code == 400
+    assert "password" in response.get_json()["error"]
+
+
+def test_missing_entry_is_json_404(client):
+    response = client.get("/api/entries/nothing")
+    assert response.status_code == 404
+    assert response.get_json()["error"]
+
+
+def test_tags_are_paged_by_popularity(client, user):
+    for number in range(5):
+        make_entry(user, "entry {}".format(number),
+                   tags=["#common"] + (["#rare"] if number == 0 else []))
+    first = client.get("/api/tags?size=1").get_json()
+    assert first["tags"] == [{"topic": "#common", "entries": 5}]
+    second = client.get("/api/tags?size=1&after=" + first["next"]).get_json()
+    assert second["tags"] == [{"topic": "#rare", "entries": 1}]
+    assert second["next"] is None
+    assert client.get("/api/tags?after=x").status_code == 400
+
+
+def test_tags_are_revalidated_with_etag(client, entry):
+    first = client.get("/api/tags")
+    again = client.get("/api/tags",
+                       headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304
@@ -0,0 +1,76 @@
+import datetime
+
+import pytest
+
+import models
+import pagination
+from tests.helpers import make_entry
+
+
+@pytest.fixture
+def entries(user):
+    """25 entries over 5 days, so dates tie and ids break the ties"""
+
+    return [
+        make_entry(user, "entry {}".format(number),
+                   date=datetime.date(2020, 1, 1 + number % 5))
+        for number in range(25)
+    ]
+
+
+def newest_first(entries):
+    return [entry.id for entry in sorted(
+        entries, key=lambda entry: (entry.date, entry.id), reverse=True)]
+
+
+def test_pages_cover_every_entry_once(entries):
+    seen = []
+    cursor = None
+    while True:
+        page = pagination.paginate(
+            models.Entry.listing(), after=cursor, size=7)
+        seen += [entry.id for entry in page]
+        cursor = page.next_cursor
+        if cursor is None:
+            break
+    assert seen == newest_first(entries)
+
+
+def test_before_walks_back_to_the_first_page(entries):
+    first = pagination.paginate(models.Entry.listing(), size=10)
+    second = pagination.paginate(
+        models.Entry.listing(), after=first.next_cursor, size=10)
+    back = pagination.paginate(
+        models.Entry.listing(), before=second.prev_cursor, size=10)
+    assert [entry.id for entry in back] == [entry.id for entry in first]
+    assert back.prev_cursor is None
+    assert back.next_cursor == first.next_cursor
+
+
+def test_malformed_cursor_raises():
+    with pytest.raises(ValueError):
+        pagination.decode_cursor("yesterday_1")
+    with pytest.raises(ValueError):
+        pagination.decode_cursor("2020-01-01_x")
+
+
+def test_page_size_is_clamped():
+    assert pagination.page_size("1000") == pagination.MAX_PAGE_SIZE
+    assert pagination.page_size("0") == 1
+    assert pagination.page_size("many", default=7) == 7
+
+
+def test_listing_rejects_bad_cursor(client, entries):
+    assert client.get("/?size=5").status_code == 200
+    assert client.get("/?after=nonsense").status_code == 400
+
+
+def test_api_pages_cover_every_entry_once(client, entries):
+    seen = []
+    url = "/api/entries?size=4&fields=id"
+    while url:
+        body = client.get(url).get_json()
+        seen += [record["id"] for record in body["entries"]]
+        url = body["next"] and (
+            "/api/entries?size=4&fields=id&after=" + body["next"])
+    assert seen == newest_first(entries)
@@ -0,0 +1,37 @@
+import pytest
+
+import cache
+import ratelimit
+from app import create_app
+from benchmark import generate, query_budget
+
+
+@pytest.fixture(scope="module")
+def measured():
+    """Statement counts for every route of a generated journal"""
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        unlimited = float("inf")
+        monkeypatch.setattr(
+            ratelimit, "IPS", ratelimit.TokenBucket(burst=unlimited))
+        monkeypatch.setattr(
+            ratelimit, "ACCOUNTS", ratelimit.TokenBucket(burst=unlimited))
+        monkeypatch.setattr(cache.PAGES, "max_size", 0)
+        monkeypatch.setattr(cache.USERS, "max_size", 0)
+        journal = generate.generate(entries=300, users=2)
+        journal.slugs.sort()
+        app = create_app(dict(query_budget.CONFIG, DATABASE=journal.path))
+        results = query_budget.measure(app.test_client(), journal)
+    return {name: (statements, status, sql)
+            for name, statements, status, sql in results}
+
+
+def test_every_route_is_measured(measured):
+    assert set(measured) == set(query_budget.BUDGETS)
+
+
+@pytest.mark.parametrize("name", sorted(query_budget.BUDGETS))
+def test_route_within_budget(measured, name):
+    statements, status, sql = measured[name]
+    assert status < 400
+    assert statements <= query_budget.BUDGETS[name], "\n".join(sql)
@@ -0,0 +1,38 @@
+import ratelimit
+
+
+def test_bucket_refuses_past_the_burst(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    bucket = ratelimit.TokenBucket(rate=1, burst=3)
+    assert [bucket.allow("a") for _ in range(4)] == [True] * 3 + [False]
+    assert bucket.allow("b")
+    now[0] += 1
+    assert bucket.allow("a")
+    assert not bucket.allow("a")
+
+
+def test_bucket_forgets_old_keys():
+    bucket = ratelimit.TokenBucket(burst=1, max_keys=2)
+    assert bucket.allow("a")
+    assert bucket.allow("b")
+    assert bucket.allow("c")
+    assert bucket.allow("a")
+
+
+def test_login_attempts_are_limited(client, user):
+    data = {"email": user.email, "password": "wrong"}
+    statuses = [client.post("/login", data=data).status_code
+                for _ in range(ratelimit.BURST + 1)]
+    assert statuses == [302] * ratelimit.BURST + [429]
+
+
+def test_each_account_has_its_own_limit(client, user, monkeypatch):
+    monkeypatch.setattr(
+        ratelimit, "IPS", ratelimit.TokenBucket(burst=float("inf")))
+    for _ in range(ratelimit.BURST):
+        client.post("/login", data={"email": user.email, "password": "x"})
+    assert client.post("/login", data={
+        "email": user.email, "password": "x"}).status_code == 429
+    assert client.post("/login", data={
+        "email": "bob@example.com", "password": "x"}).status_code == 302
@@ -0,0 +1,57 @@
+import pytest
+
+import search
+from tests.helpers import make_entry
+
+
+def test_match_expression_quotes_every_term():
+    assert search.match_expression('python OR "flask') == (
+        '"python" "OR" "flask"')
+    assert search.match_expression("  ---  ") is None
+
+
+def test_better_matches_rank_first(user):
+    make_entry(user, "Notes", content="python " + "filler " * 60)
+    make_entry(user, "Python guide", content="python python python")
+    make_entry(user, "Unrelated", content="nothing to see")
+    page = search.search_entries("python")
+    assert [entry.title for entry in page] == ["Python guide", "Notes"]
+
+
+def test_resources_are_searched(user):
+    make_entry(user, "Reading", resources=[("Fluent Python", None)])
+    assert [entry.title for entry in search.search_entries("fluent")] == [
+        "Reading"]
+
+
+def test_pages_cover_every_match_once(user):
+    for number in range(12):
+        make_entry(user, "entry {}".format(number),
+                   content="python " + "word " * number)
+    seen = []
+    cursor = None
+    while True:
+        page = search.search_entries("python", after=cursor, size=5)
+        seen += [entry.id for entry in page]
+        cursor = page.next_cursor
+        if cursor is None:
+            break
+    assert len(seen) == len(set(seen)) == 12
+
+
+def test_snippets_are_highlighted_and_escaped(user):
+    make_entry(user, "Markup", content="learning <b>python</b> today")
+    entry, = search.search_entries("python")
+    assert "<mark>python</mark>" in entry.snippet
+    assert "<b>" not in entry.snippet
+
+
+@pytest.mark.parametrize("text", ['python"', "NEAR(", "a AND", "*", ""])
+def test_search_page_accepts_any_text(client, user, text):
+    make_entry(user, "Python", content="python")
+    assert client.get("/search", query_string={"q": text}).status_code == 200
+
+
+def test_search_page_rejects_bad_cursor(client):
+    response = client.get("/search?q=python&after=nonsense")
+    assert response.status_code == 400
@@ -0,0 +1,74 @@
+import io
+import logging
+
+import jobs
+import migrations
+import models
+import search
+import transfer
+from tests.helpers import make_entry, make_user
+
+
+def exported():
+    stream = io.StringIO()
+    transfer.export_journal(stream, batch_size=2)
+    return stream.getvalue()
+
+
+def fresh_journal():
+    models.init_database(models.MEMORY)
+    migrations.migrate()
+
+
+def fill(user):
+    make_entry(user, "First", content="python notes", tags=["#python"],
+               resources=[("Docs", "https://example.com"), ("Book", None)])
+    make_entry(make_user("bob"), "Second", tags=["#python", "#flask"])
+    make_entry(user, "Third")
+
+
+def test_round_trip(app, user):
+    fill(user)
+    text = exported()
+    fresh_journal()
+    users, entries, skipped = transfer.import_journal(
+        io.StringIO(text), batch_size=2)
+    assert (users, entries, skipped) == (2, 3, 0)
+    assert exported() == text
+
+
+def test_import_maintains_derived_tables(app, user):
+    fill(user)
+    text = exported()
+    fresh_journal()
+    transfer.import_journal(io.StringIO(text))
+    assert dict(models.Tag.select(models.Tag.topic, models.Tag.entry_count)
+                .tuples()) == {"#python": 2, "#flask": 1}
+    assert [entry.title for entry in search.search_entries("docs")] == [
+        "First"]
+    assert models.UserRollup.select().where(
+        models.UserRollup.period == "day").count() == 2
+    jobs.drain()
+    first = models.Entry.get(models.Entry.title == "First")
+    assert [entry.title for entry in models.related_entries(first)] == [
+        "Second"]
+
+
+def test_import_twice_skips_everything(app, user):
+    fill(user)
+    text = exported()
+    assert transfer.import_journal(io.StringIO(text)) == (0, 0, 3)
+
+
+def test_taken_titles_are_skipped(app, user, caplog):
+    fill(user)
+    text = exported()
+    fresh_journal()
+    taken = make_entry(make_user(), "Renamed", content="already here")
+    taken.title = "First"
+    taken.save()
+    with caplog.at_level(logging.WARNING, logger="journal.transfer"):
+        assert transfer.import_journal(io.StringIO(text)) == (1, 2, 1)
+    assert "'First' is taken" in caplog.text
+    assert models.Entry.get(models.Entry.title == "First").content == (
+        "already here")
@@ -0,0 +1,294 @@
+import gzip
+import io
+import json
+import logging
+import sys
+
+from peewee import chunked
+
+import handlers
+import models
+import rendering
+
+
+BATCH_SIZE = 500
+MAX_VARIABLES = 999
+
+log = logging.getLogger("journal.transfer")
+
+
+def open_stream(path, mode, compress=None):
+    """
+    Opens path for reading ("r") or writing ("w") as text. "-" means stdin
+    or stdout. Files are gzipped when compress is true, or when it is None
+    and the path ends in ".gz".
+    """
+
+    if compress is None:
+        compress = path.endswith(".gz")
+    if path == "-":
+        raw = sys.stdin.buffer if mode == "r" else sys.stdout.buffer
+        if compress:
+            raw = gzip.GzipFile(fileobj=raw, mode=mode + "b")
+        return io.TextIOWrapper(raw, encoding="utf-8")
+    if compress:
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def insert_rows(model, fields, rows, ignore=False):
+    """
+    Bulk inserts rows, split into statements small enough to stay under
+    SQLite's bound variable limit
+
+    Returns:
+    Number of rows inserted, leaving out rows ignored as duplicates
+    """
+
+    count = 0
+    for chunk in chunked(rows, max(1, MAX_VARIABLES // len(fields))):
+        query = model.insert_many(chunk, fields=fields)
+        if ignore:
+            query = query.on_conflict_ignore()
+        count += models.DATABASE.execute(query).rowcount
+    return count
+
+
+def user_record(user):
+    """Serializes a User for export, password hash included"""
+
+    return {
+        "type": "user",
+        "username": user.username,
+        "email": user.email,
+        "password": user.password,
+        "is_admin": user.is_admin,
+    }
+
+
+def entry_record(entry):
+    """Serializes an Entry with its author, tags and resources for export"""
+
+    return {
+        "type": "entry",
+        "author": entry.author.username,
+        "title": entry.title,
+        "slug": entry.slug,
+        "content": entry.content,
+        "date": str(entry.date),
+        "time_spent": entry.time_spent,
+        "tags": entry.tag_list,
+        "resources": [
+            {"title": resource.title, "link": resource.link}
+            for resource in entry.resource_list
+        ],
+    }
+
+
+def export_journal(stream, batch_size=BATCH_SIZE):
+    """
+    Writes every user, then every entry, as one JSON object per line.
+    Rows are read in id order a batch at a time, with tags and resources
+    loaded per batch, so memory use doesn't depend on the journal size.
+
+    Returns:
+    Number of records written
+    """
+
+    written = 0
+    last_id = 0
+    while True:
+        users = list(
+            models.User.select().where(
+                models.User.id > last_id
+            ).order_by(models.User.id).limit(batch_size)
+        )
+        if not users:
+            break
+        for user in users:
+            stream.write(json.dumps(user_record(user)) + "\n")
+        written += len(users)
+        last_id = users[-1].id
+
+    last_id = 0
+    while True:
+        entries = list(
+            models.Entry.select(models.Entry, models.User).join(
+                models.User, on=models.Entry.author
+            ).where(
+                models.Entry.id > last_id
+            ).order_by(models.Entry.id).limit(batch_size)
+        )
+        if not entries:
+            break
+        models.prefetch_tags(entries)
+        models.prefetch_resources(entries)
+        for entry in entries:
+            stream.write(json.dumps(entry_record(entry)) + "\n")
+        written += len(entries)
+        last_id = entries[-1].id
+    return written
+
+
+def import_users(records):
+    """Inserts a batch of user records, skipping usernames already taken
+
+    Returns:
+    Number of users inserted
+    """
+
+    return insert_rows(
+        models.User,
+        [models.User.username, models.User.email, models.User.password,
+         models.User.is_admin],
+        [(record["username"], record["email"], record["password"],
+          record.get("is_admin", False)) for record in records],
+        ignore=True,
+    )
+
+
+def import_entries(records):
+    """
+    Inserts a batch of entry records with their tags and resources using
+    a fixed number of bulk statements. Entries whose slug already exists,
+    or whose author is unknown, are skipped. So are entries whose title
+    another entry already has, as titles are unique too; each of those
+    is logged.
+
+    Returns:
+    Number of entries inserted
+    """
+
+    records = list({record["slug"]: record for record in records}.values())
+    authors = dict(
+        models.User.select(models.User.username, models.User.id).where(
+            models.User.username.in_(
+                list({record["author"] for record in records}))
+        ).tuples()
+    )
+    existing = {
+        slug for slug, in models.Entry.select(models.Entry.slug).where(
+            models.Entry.slug.in_([record["slug"] for record in records])
+        ).tuples()
+    }
+    records = [
+        record for record in records
+        if record["slug"] not in existing and record["author"] in authors
+    ]
+    taken = {
+        title for title, in models.Entry.select(models.Entry.title).where(
+            models.Entry.title.in_([record["title"] for record in records])
+        ).tuples()
+    }
+    kept = []
+    for record in records:
+        if record["title"] in taken:
+            log.warning("Skipped entry %s: the title %r is taken",
+                        record["slug"], record["title"])
+            continue
+        taken.add(record["title"])
+        kept.append(record)
+    records = kept
+    if not records:
+        return 0
+
+    rows = []
+    for record in records:
+        content_html = rendering.render(record["content"])
+        rows.append((
+            authors[record["author"]], record["title"], record["content"],
+            record["date"], record["time_spent"], record["slug"],
+            content_html, rendering.excerpt(content_html),
+            rendering.RENDERER_VERSION,
+        ))
+    insert_rows(
+        models.Entry,
+        [models.Entry.author, models.Entry.title, models.Entry.content,
+         models.Entry.date, models.Entry.time_spent, models.Entry.slug,
+         models.Entry.content_html, models.Entry.excerpt,
+         models.Entry.renderer_version],
+        rows,
+        ignore=True,
+    )
+    entry_ids = dict(
+        models.Entry.select(models.Entry.slug, models.Entry.id).where(
+            models.Entry.slug.in_([record["slug"] for record in records])
+        ).tuples()
+    )
+
+    topics = list({
+        topic for record in records for topic in record.get("tags", ())
+    })
+    if topics:
+        insert_rows(models.Tag, [models.Tag.topic],
+                    [(topic,) for topic in topics], ignore=True)
+        tag_ids = dict(
+            models.Tag.select(models.Tag.topic, models.Tag.id).where(
+                models.Tag.topic.in_(topics)
+            ).tuples()
+        )
+        insert_rows(
+            models.EntryTag,
+            [models.EntryTag.entry, models.EntryTag.tag],
+            [(entry_ids[record["slug"]], tag_ids[topic])
+             for record in records if record["slug"] in entry_ids
+             for topic in record.get("tags", ())],
+            ignore=True,
+        )
+
+    insert_rows(
+        models.Resource,
+        [models.Resource.entry, models.Resource.title, models.Resource.link],
+        [(entry_ids[record["slug"]], resource["title"], resource.get("link"))
+         for record in records if record["slug"] in entry_ids
+         for resource in record.get("resources", ())],
+    )
+    return len(entry_ids)
+
+
+def import_journal(stream, batch_size=BATCH_SIZE):
+    """
+    Reads records written by export_journal and inserts them batch by
+    batch, each batch in its own transaction, so memory use is bounded
+    by the batch size rather than by the file. The search index, tag
+    counts, rollups and cache events are not maintained row by row
+    meanwhile but rebuilt once at the end, which also picks up writes
+    the app made during the import. Imported entries change the related
+    entries of the whole journal, so refreshing them is queued as one
+    background job per batch.
+
+    Returns:
+    Tuple of the number of users inserted, entries inserted and entry
+    records skipped
+    """
+
+    read = 0
+    counts = {"user": 0, "entry": 0}
+    importers = {"user": import_users, "entry": import_entries}
+    batches = {"user": [], "entry": []}
+
+    def flush(kind):
+        if batches[kind]:
+            with models.DATABASE.atomic():
+                counts[kind] += importers[kind](batches[kind])
+            batches[kind] = []
+
+    with models.deferred_cache_events(), models.deferred_tag_counts(), \
+            models.deferred_search_index(), models.deferred_rollups():
+        for line in stream:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            kind = record.get("type", "entry")
+            if kind == "entry":
+                flush("user")
+                read += 1
+            batches[kind].append(record)
+            if len(batches[kind]) >= batch_size:
+                flush(kind)
+        flush("user")
+        flush("entry")
+    if counts["entry"]:
+        with models.DATABASE.atomic():
+            handlers.enqueue_related_rebuild(batch_size)
+    return counts["user"], counts["entry"], read - counts["entry"]
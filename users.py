@@ -0,0 +1,97 @@
+import time
+
+from flask import current_app, session
+from flask_login import UserMixin
+
+import cache
+import models
+
+
+SIGNED_SESSION = False
+SESSION_KEY = "user_claims"
+
+session_hits = 0
+
+
+class SessionUser(UserMixin):
+    """User rebuilt from the claims stored in the signed session cookie
+
+    Carries just what pages display, so requests that only render the
+    layout don't need to query the user table at all.
+
+    Attributes:
+    id (int): id of the User
+    username (str): user's name that will be displayed within app
+    is_admin (bool): user's admin status
+    """
+
+    def __init__(self, id, username, is_admin):
+        self.id = id
+        self.username = username
+        self.is_admin = is_admin
+
+
+def signed_session():
+    """
+    Whether the app keeps user claims in the session, its SIGNED_SESSION
+    setting
+    """
+
+    return current_app.config.get("SIGNED_SESSION", SIGNED_SESSION)
+
+
+def get_user(userid):
+    """Returns the User with userid, from cache.USERS when possible
+
+    Raises DoesNotExist if there is no such user.
+    """
+
+    userid = int(userid)
+    stamp = cache.position
+    user = cache.USERS.get(userid)
+    if user is None:
+        user = models.User.get(models.User.id == userid)
+        cache.store(cache.USERS, userid, user, stamp)
+    return user
+
+
+def remember(user):
+    """Stores the claims of user in the session for SIGNED_SESSION mode"""
+
+    if signed_session():
+        session[SESSION_KEY] = {
+            "id": user.id,
+            "username": user.username,
+            "is_admin": user.is_admin,
+            "checked": time.time(),
+        }
+
+
+def forget():
+    """Removes any user claims from the session"""
+
+    session.pop(SESSION_KEY, None)
+
+
+def load_user(userid):
+    """
+    Resolves the logged in user. In SIGNED_SESSION mode the session claims
+    are trusted for up to cache.USER_TTL seconds before being re-checked
+    against the database; otherwise the user comes from get_user.
+
+    Raises DoesNotExist if there is no such user.
+    """
+
+    global session_hits
+
+    if signed_session():
+        claims = session.get(SESSION_KEY)
+        if (claims and str(claims["id"]) == str(userid)
+                and time.time() - claims["checked"] < cache.USER_TTL):
+            session_hits += 1
+            return SessionUser(
+                claims["id"], claims["username"], claims["is_admin"])
+        user = get_user(userid)
+        remember(user)
+        return user
+    return get_user(userid)
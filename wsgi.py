@@ -0,0 +1,14 @@
+"""
+Production entry point for WSGI servers, e.g.
+
+    gunicorn --workers 4 --bind 0.0.0.0:8000 wsgi:app
+
+Settings come from JOURNAL_* environment variables (see DEFAULTS in
+app.py). Creating the app opens no database connection, so --preload is
+safe: every worker opens its own pool after the fork.
+"""
+
+from app import create_app
+
+
+app = create_app()